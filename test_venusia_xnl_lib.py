@@ -0,0 +1,787 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy
+import pytest
+
+import venusia_xnl_lib
+
+
+def variable_xml(name, idata_type, values):
+    elements = "".join('<element value="%s"/>' % value for value in values)
+    return '<variable name="%s" type="%s">%s</variable>' % (name, idata_type, elements)
+
+
+def write_experiment(tmp_path, variables, operations, devices=(("motor", "sim/motor/1"),), devices_xml=""):
+    xml = ("<experiment><variables>%s</variables><devices>%s%s</devices><operations>%s</operations></experiment>"
+           % ("".join(variables), "".join('<device name="%s" tango_path="%s"/>' % device for device in devices),
+              devices_xml, "".join(operations)))
+    xml_file_path = tmp_path / "experiment.xml"
+    xml_file_path.write_text(xml)
+    return str(xml_file_path)
+
+
+def simulated_pool(attributes=None, proxy_class=venusia_xnl_lib.SimulatedDeviceProxy):
+    return venusia_xnl_lib.ProxyPool(lambda tango_path: proxy_class(tango_path, attributes))
+
+
+def run_experiment(xml_file_path, pool, **options):
+    experiment = venusia_xnl_lib.Experiment(pool, **options)
+    experiment.parse_xml(xml_file_path)
+    return experiment
+
+
+class RecordingDeviceProxy(venusia_xnl_lib.SimulatedDeviceProxy):
+
+    def __init__(self, tango_path, attributes=None):
+        venusia_xnl_lib.SimulatedDeviceProxy.__init__(self, tango_path, attributes)
+        self.history = []
+
+    def write_attribute(self, attr_name, value):
+        self.history.append(("write_attribute", [attr_name]))
+        venusia_xnl_lib.SimulatedDeviceProxy.write_attribute(self, attr_name, value)
+
+    def write_attributes(self, name_values):
+        self.history.append(("write_attributes", [attr_name for attr_name, _ in name_values]))
+        venusia_xnl_lib.SimulatedDeviceProxy.write_attributes(self, name_values)
+
+
+def test_batch_splits_repeated_writes(tmp_path):
+    xml_file_path = write_experiment(tmp_path, [], [
+        '<write_attribute tango_device_name="motor" tango_attr_name="Trigger" tango_attr_value="1"/>',
+        '<write_attribute tango_device_name="motor" tango_attr_name="Gain" tango_attr_value="2"/>',
+        '<write_attribute tango_device_name="motor" tango_attr_name="Trigger" tango_attr_value="0"/>',
+    ])
+    pool = simulated_pool(proxy_class=RecordingDeviceProxy)
+    run_experiment(xml_file_path, pool)
+    device = pool.get("sim/motor/1")
+    assert device.history == [("write_attributes", ["Trigger", "Gain"]), ("write_attribute", ["Trigger"])]
+    assert device.attributes["Trigger"] == 0
+
+
+def test_batch_opt_out(tmp_path):
+    xml_file_path = write_experiment(tmp_path, [], [
+        '<write_attribute tango_device_name="motor" tango_attr_name="A" tango_attr_value="1"/>',
+        '<write_attribute tango_device_name="motor" tango_attr_name="B" tango_attr_value="2" batch="false"/>',
+        '<write_attribute tango_device_name="motor" tango_attr_name="C" tango_attr_value="3"/>',
+    ])
+    pool = simulated_pool(proxy_class=RecordingDeviceProxy)
+    run_experiment(xml_file_path, pool)
+    assert pool.get("sim/motor/1").history == [("write_attribute", ["A"]), ("write_attribute", ["B"]),
+                                               ("write_attribute", ["C"])]
+
+
+class RampDeviceProxy(venusia_xnl_lib.SimulatedDeviceProxy):
+
+    # ogni lettura di Position avanza di 1: il polling vede il valore salire
+
+    def read_attribute(self, attr_name):
+        attribute = venusia_xnl_lib.SimulatedDeviceProxy.read_attribute(self, attr_name)
+        self.attributes[attr_name] += 1
+        return attribute
+
+
+class FakeEvent:
+
+    def __init__(self, value, errors=None):
+        self.err = errors is not None
+        self.errors = errors
+        self.attr_value = venusia_xnl_lib.SimulatedAttribute("Position", value)
+
+
+class ErrorEventDeviceProxy(venusia_xnl_lib.SimulatedDeviceProxy):
+
+    def subscribe_event(self, attr_name, event_type, callback):
+        callback(FakeEvent(None, "device not reachable"))
+        return 1
+
+    def unsubscribe_event(self, event_id):
+        pass
+
+
+class EventDeviceProxy(venusia_xnl_lib.SimulatedDeviceProxy):
+
+    # sorgente di eventi locale: un thread spinge change event finche' non si chiude
+
+    def __init__(self, tango_path, attributes=None):
+        venusia_xnl_lib.SimulatedDeviceProxy.__init__(self, tango_path, attributes)
+        self.callbacks = {}
+        self.unsubscribed = []
+
+    def subscribe_event(self, attr_name, event_type, callback):
+        event_id = len(self.callbacks) + 1
+        self.callbacks[event_id] = callback
+        thread = venusia_xnl_lib.threading.Thread(target=self.push_events, args=(callback,), daemon=True)
+        thread.start()
+        return event_id
+
+    def push_events(self, callback):
+        for value in range(1, 6):
+            venusia_xnl_lib.time.sleep(0.01)
+            callback(FakeEvent(float(value)))
+
+    def unsubscribe_event(self, event_id):
+        self.unsubscribed.append(event_id)
+
+
+def wait_until_experiment(tmp_path, timeout=5, extra="", children=""):
+    return write_experiment(tmp_path, [
+        variable_xml("position_attr", "string_scalar", ["Position"]),
+        variable_xml("position", "float_scalar", [0]),
+        variable_xml("target", "float_scalar", [3]),
+    ], ['<wait_until tango_device_name="motor" tango_attr_name="position_attr" var1="position" operator="greaterequal"'
+        ' var2="target" timeout="%s" poll_min_period="0.001" poll_max_period="0.01"%s>%s</wait_until>'
+        % (timeout, extra, children)])
+
+
+def test_wait_until_polling(tmp_path):
+    pool = simulated_pool({"Position": 0.0}, RampDeviceProxy)
+    experiment = run_experiment(wait_until_experiment(tmp_path), pool)
+    assert experiment.variables["position"].idata_value == 3.0
+    assert pool.get("sim/motor/1").calls["read_attribute"] == 4
+
+
+def test_wait_until_events(tmp_path):
+    pool = simulated_pool({"Position": 0.0}, EventDeviceProxy)
+    experiment = run_experiment(wait_until_experiment(tmp_path), pool)
+    assert experiment.variables["position"].idata_value >= 3.0
+    device = pool.get("sim/motor/1")
+    assert len(device.callbacks) == 1
+    assert device.unsubscribed == [1]
+
+
+def test_wait_until_timeout(tmp_path):
+    with pytest.raises(Exception, match="timed out"):
+        run_experiment(wait_until_experiment(tmp_path, timeout=0.05), simulated_pool({"Position": 0.0}))
+
+
+def test_wait_until_error_event(tmp_path):
+    with pytest.raises(Exception, match="device not reachable"):
+        run_experiment(wait_until_experiment(tmp_path), simulated_pool({"Position": 0.0}, ErrorEventDeviceProxy))
+
+
+def test_wait_until_rejects_children(tmp_path):
+    xml_file_path = wait_until_experiment(tmp_path, children='<log message="never"/>')
+    with pytest.raises(Exception, match="does not take child operations"):
+        run_experiment(xml_file_path, simulated_pool({"Position": 0.0}))
+
+
+def parallel_experiment(tmp_path, branches):
+    return write_experiment(tmp_path, [
+        variable_xml("n", "int_scalar", [3]),
+        variable_xml("i", "int_scalar", [0]),
+        variable_xml("step", "int_spectrum", [1, 1]),
+        variable_xml("position_attr", "string_scalar", ["Position"]),
+        variable_xml("missing_attr", "string_scalar", ["Missing"]),
+        variable_xml("a", "float_scalar", [0]),
+        variable_xml("b", "float_scalar", [0]),
+        variable_xml("c", "float_scalar", [0]),
+    ], ["<parallel>%s</parallel>" % "".join(branches)],
+        devices=(("motor1", "sim/motor/1"), ("motor2", "sim/motor/2"), ("motor3", "sim/motor/3")))
+
+
+def parallel_read(device_name, var_name, attr_name="position_attr"):
+    return ('<read_attribute tango_device_name="%s" tango_attr_name="%s" var_name="%s"/>'
+            % (device_name, attr_name, var_name))
+
+
+def test_parallel_branches_overlap(tmp_path):
+    xml_file_path = parallel_experiment(tmp_path, [parallel_read("motor1", "a"), parallel_read("motor2", "b"),
+                                                   parallel_read("motor3", "c")])
+    pool = venusia_xnl_lib.ProxyPool(venusia_xnl_lib.simulated_proxy_factory({"Position": 1.5}, latency=0.1))
+    pool.get_all(["sim/motor/1", "sim/motor/2", "sim/motor/3"], [None] * 3)
+    started = venusia_xnl_lib.time.monotonic()
+    experiment = run_experiment(xml_file_path, pool)
+    # tre letture da 100 ms: in serie sarebbero 300 ms
+    assert venusia_xnl_lib.time.monotonic() - started < 0.2
+    assert [experiment.variables[name].idata_value for name in "abc"] == [1.5, 1.5, 1.5]
+
+
+@pytest.mark.parametrize("failing", [0, 2])
+def test_parallel_error_joins_siblings(tmp_path, failing):
+    branches = [parallel_read("motor1", "a"), parallel_read("motor2", "b"), parallel_read("motor3", "c")]
+    branches[failing] = parallel_read("motor%d" % (failing + 1), "abc"[failing], "missing_attr")
+    xml_file_path = parallel_experiment(tmp_path, branches)
+    pool = venusia_xnl_lib.ProxyPool(venusia_xnl_lib.simulated_proxy_factory({"Position": 1.5}, latency=0.05))
+    with pytest.raises(Exception, match="Attribute Missing not found"):
+        run_experiment(xml_file_path, pool)
+    # l'errore arriva solo dopo il join: i rami in corso hanno finito, nessuno resta a scrivere variabili
+    for index in range(3):
+        if index != failing:
+            assert pool.get("sim/motor/%d" % (index + 1)).calls["read_attribute"] == 1
+
+
+def test_parallel_rejects_conflicting_branches(tmp_path):
+    xml_file_path = parallel_experiment(tmp_path, [
+        parallel_read("motor1", "a"),
+        parallel_read("motor2", "a"),
+        '<cycle var_name="i" cycles="n" step="step"><set_variable var_name="b" expression="i"/></cycle>',
+        '<if var1="i" operator="greater" var2="c"><set_variable var_name="c" expression="1"/></if>',
+    ])
+    with pytest.raises(Exception) as error:
+        run_experiment(xml_file_path, simulated_pool({"Position": 1.5}))
+    message = str(error.value)
+    assert "Variable a written by more than one branch of parallel" in message
+    assert "Variable i read by one branch of parallel and written by another" in message
+
+
+class ConnectFactory:
+
+    # costruttore di proxy finto: conta le connessioni, simula la latenza, i device morti e i primi tentativi falliti
+
+    def __init__(self, connect_latency=0.0, failures=0):
+        self.connect_latency = connect_latency
+        self.failures = failures
+        self.connected = []
+        self.released = venusia_xnl_lib.threading.Event()
+        self.lock = venusia_xnl_lib.threading.Lock()
+
+    def __call__(self, tango_path):
+        with self.lock:
+            self.connected.append(tango_path)
+            failed = self.failures > 0
+            self.failures -= 1
+        if tango_path.startswith("dead/"):
+            self.released.wait(5)
+            raise Exception("device %s not exported" % tango_path)
+        if failed:
+            raise Exception("device %s not exported" % tango_path)
+        return venusia_xnl_lib.SimulatedDeviceProxy(tango_path, {"Position": 1.5}, connect_latency=self.connect_latency)
+
+
+def connect_experiment(tmp_path, devices, devices_xml="", used=("motor1",)):
+    return write_experiment(tmp_path, [
+        variable_xml("position_attr", "string_scalar", ["Position"]),
+        variable_xml("position", "float_scalar", [0]),
+    ], ['<read_attribute tango_device_name="%s" tango_attr_name="position_attr" var_name="position"/>' % device_name
+        for device_name in used], devices=devices, devices_xml=devices_xml)
+
+
+MOTORS = (("motor1", "sim/motor/1"), ("motor2", "sim/motor/2"), ("motor3", "sim/motor/3"))
+
+
+def test_devices_connect_concurrently(tmp_path):
+    factory = ConnectFactory(connect_latency=0.1)
+    started = venusia_xnl_lib.time.monotonic()
+    run_experiment(connect_experiment(tmp_path, MOTORS), venusia_xnl_lib.ProxyPool(factory))
+    # tre connessioni da 100 ms: in serie sarebbero 300 ms
+    assert venusia_xnl_lib.time.monotonic() - started < 0.2
+    assert sorted(factory.connected) == ["sim/motor/1", "sim/motor/2", "sim/motor/3"]
+
+
+def test_connect_timeout_fails_fast_on_dead_device(tmp_path):
+    factory = ConnectFactory()
+    xml_file_path = connect_experiment(tmp_path, MOTORS[:1],
+                                       '<device name="dead" tango_path="dead/motor/1" connect_timeout="0.05"/>')
+    started = venusia_xnl_lib.time.monotonic()
+    try:
+        with pytest.raises(Exception, match="dead/motor/1: connection timeout"):
+            run_experiment(xml_file_path, venusia_xnl_lib.ProxyPool(factory))
+        assert venusia_xnl_lib.time.monotonic() - started < 1
+    finally:
+        factory.released.set()
+
+
+def test_pool_shared_between_experiments(tmp_path):
+    factory = ConnectFactory()
+    pool = venusia_xnl_lib.ProxyPool(factory)
+    xml_file_path = connect_experiment(tmp_path, MOTORS[:2])
+    first = run_experiment(xml_file_path, pool)
+    second = run_experiment(xml_file_path, pool)
+    assert sorted(factory.connected) == ["sim/motor/1", "sim/motor/2"]
+    assert first.devices["motor1"] is second.devices["motor1"]
+
+
+def test_failed_connect_is_retried(tmp_path):
+    factory = ConnectFactory(failures=1)
+    pool = venusia_xnl_lib.ProxyPool(factory)
+    xml_file_path = connect_experiment(tmp_path, MOTORS[:1])
+    with pytest.raises(Exception, match="sim/motor/1: device sim/motor/1 not exported"):
+        run_experiment(xml_file_path, pool)
+    assert run_experiment(xml_file_path, pool).variables["position"].idata_value == 1.5
+    assert factory.connected == ["sim/motor/1", "sim/motor/1"]
+
+
+def test_lazy_devices_connect_on_first_use(tmp_path):
+    factory = ConnectFactory()
+    xml_file_path = connect_experiment(tmp_path, MOTORS[:1],
+                                       '<device name="dead" tango_path="dead/motor/1" connect_timeout="0.05"/>')
+    experiment = run_experiment(xml_file_path, venusia_xnl_lib.ProxyPool(factory), lazy_devices=True)
+    # il device morto non e' usato da nessuna operazione: con lazy_devices non si prova neppure a connetterlo
+    assert factory.connected == ["sim/motor/1"]
+    assert experiment.variables["position"].idata_value == 1.5
+
+
+def scheduled_experiment(tmp_path, name, tango_path, attr_name="Position"):
+    directory = tmp_path / name
+    directory.mkdir()
+    return write_experiment(directory, [
+        variable_xml("position_attr", "string_scalar", [attr_name]),
+        variable_xml("position", "float_scalar", [0]),
+    ], ['<read_attribute tango_device_name="motor" tango_attr_name="position_attr" var_name="position"/>',
+        '<log message="done"/>'], devices=(("motor", tango_path),))
+
+
+def scheduler_pool():
+    return venusia_xnl_lib.ProxyPool(venusia_xnl_lib.simulated_proxy_factory({"Position": 1.5}, latency=0.05))
+
+
+def test_scheduler_serializes_shared_devices(tmp_path):
+    scheduler = venusia_xnl_lib.ExperimentScheduler(max_workers=4, proxy_pool=scheduler_pool())
+    try:
+        jobs = [scheduler.enqueue(scheduled_experiment(tmp_path, "e%d" % index, "sim/motor/1")) for index in range(3)]
+        for job in jobs:
+            job.future.result(5)
+    finally:
+        scheduler.shutdown()
+    # stesso device: uno alla volta, nell'ordine in cui sono stati sottomessi
+    for previous, job in zip(jobs, jobs[1:]):
+        assert job.started >= previous.finished
+
+
+def test_scheduler_overlaps_disjoint_devices(tmp_path):
+    scheduler = venusia_xnl_lib.ExperimentScheduler(max_workers=4, proxy_pool=scheduler_pool())
+    try:
+        reports = scheduler.run([scheduled_experiment(tmp_path, "e%d" % index, "sim/motor/%d" % index)
+                                 for index in range(3)])
+        jobs = scheduler.jobs
+    finally:
+        scheduler.shutdown()
+    assert max(job.started for job in jobs) < min(job.finished for job in jobs)
+    # il throughput c'e' anche senza profiler: due operazioni di primo livello per esperimento
+    assert [report["operations"] for report in reports] == [2, 2, 2]
+    assert all(report["ops_per_s"] > 0 and report["error"] is None for report in reports)
+
+
+def test_scheduler_failure_releases_devices(tmp_path):
+    scheduler = venusia_xnl_lib.ExperimentScheduler(max_workers=2, proxy_pool=scheduler_pool())
+    try:
+        failing = scheduler.submit(scheduled_experiment(tmp_path, "failing", "sim/motor/1", "Missing"))
+        following = scheduler.submit(scheduled_experiment(tmp_path, "following", "sim/motor/1"))
+        assert following.result(5)["error"] is None
+    finally:
+        scheduler.shutdown()
+    assert "Attribute Missing not found" in str(failing.exception())
+    assert scheduler.reports()[0]["error"] == str(failing.exception())
+    assert scheduler.busy_paths == set()
+
+
+def test_profiler_counts_operations_and_device_calls(tmp_path):
+    xml_file_path = write_experiment(tmp_path, [
+        variable_xml("n", "int_scalar", [3]),
+        variable_xml("i", "int_scalar", [0]),
+        variable_xml("step", "int_spectrum", [1, 1]),
+        variable_xml("position_attr", "string_scalar", ["Position"]),
+        variable_xml("position", "float_scalar", [0]),
+    ], ['<cycle var_name="i" cycles="n" step="step">'
+        '<read_attribute tango_device_name="motor" tango_attr_name="position_attr" var_name="position"/>'
+        '<set_variable var_name="position" expression="position + 1"/></cycle>'])
+    profiler = venusia_xnl_lib.Profiler()
+    run_experiment(xml_file_path, simulated_pool({"Position": 1.5}), profiler=profiler)
+    assert {node: stats[0] for node, stats in profiler.operation_stats.items()} == {
+        "/0:cycle": 1, "/0:cycle/0:read_attribute": 3, "/0:cycle/1:set_variable": 3}
+    calls, total, maximum, histogram = profiler.device_stats[("motor", "Position", "read_attribute")]
+    assert calls == 3 and 0 < maximum <= total
+    assert sum(histogram.values()) == 3
+    assert profiler.mean_latency("motor", "Position", "read_attribute") == total / 3 / 1e9
+    assert "read_attribute motor/Position" in profiler.summary()
+
+    trace_file_path = tmp_path / "trace.json"
+    profiler.write_trace(str(trace_file_path))
+    events = json.loads(trace_file_path.read_text())["traceEvents"]
+    assert len(events) == 10
+    assert {event["cat"] for event in events} == {"operation", "tango"}
+    for event in events:
+        assert event["ph"] == "X" and event["dur"] >= 0 and event["ts"] >= 0
+        assert set(event) == {"name", "cat", "ph", "pid", "tid", "ts", "dur"}
+
+
+def test_validation_collects_errors_before_connecting(tmp_path):
+    xml_file_path = write_experiment(tmp_path, [
+        variable_xml("n", "float_scalar", [3]),
+        variable_xml("position_attr", "string_scalar", ["Position"]),
+    ], [
+        '<read_attribute tango_device_name="motor" tango_attr_name="position_attr" var_name="missing"/>',
+        '<write_attribute tango_device_name="ghost" tango_attr_name="Position" tango_attr_value="1"/>',
+        '<cycle var_name="position_attr" cycles="n" step="n"></cycle>',
+    ])
+    connected = []
+
+    def factory(tango_path):
+        connected.append(tango_path)
+        raise AssertionError("validation must fail before connecting %s" % tango_path)
+
+    with pytest.raises(Exception) as error:
+        run_experiment(xml_file_path, venusia_xnl_lib.ProxyPool(factory))
+    message = str(error.value)
+    assert message.startswith("Experiment validation failed:")
+    assert "missing" in message
+    assert "ghost" in message
+    assert "The type of the variable n used in cycle is not int" in message
+    assert connected == []
+
+
+def test_log_visible_without_logging_configuration(tmp_path):
+    xml_file_path = write_experiment(tmp_path, [variable_xml("counter", "int_scalar", [7])],
+                                     ['<log message="counter is {}"><parameter var="counter"/></log>'], devices=())
+    script = "import venusia_xnl_lib; venusia_xnl_lib.Experiment().parse_xml(%r)" % xml_file_path
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(venusia_xnl_lib.__file__)))
+    assert output.stdout == "counter is 7\n"
+
+
+CONCURRENT_LOGGING_SCRIPT = """
+import threading
+import venusia_xnl_lib
+registered = []
+venusia_xnl_lib.atexit.register = registered.append
+barrier = threading.Barrier(8)
+def configure():
+    barrier.wait()
+    venusia_xnl_lib.configure_default_logging()
+threads = [threading.Thread(target=configure) for _ in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+venusia_xnl_lib.logger.info("configured once")
+venusia_xnl_lib.stop_logging()
+print(len(venusia_xnl_lib.logger.handlers), len(registered))
+"""
+
+
+def test_default_logging_configured_once_across_threads():
+    output = subprocess.run([sys.executable, "-c", CONCURRENT_LOGGING_SCRIPT], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(venusia_xnl_lib.__file__)))
+    assert output.stdout == "configured once\n1 1\n"
+
+
+def test_recorder_chunks_by_bytes(tmp_path):
+    path = str(tmp_path / "spectra")
+    recorder = venusia_xnl_lib.Recorder(path, ["index", "spectrum"], [numpy.int64, numpy.float64],
+                                        venusia_xnl_lib.RECORD_FORMAT_BINARY)
+    for index in range(5):
+        recorder.append([index, numpy.full(65536, float(index))])
+    # 65536 float64 sono 512 KiB a riga: due righe per chunk con il limite di 1 MiB
+    assert recorder.chunk_rows == 2
+    assert all(column.nbytes <= venusia_xnl_lib.RECORD_CHUNK_BYTES for column in recorder.buffer)
+    recorder.close()
+    record = venusia_xnl_lib.load_record(path)
+    assert list(record["index"]) == [0, 1, 2, 3, 4]
+    assert record["spectrum"].shape == (5, 65536)
+    assert record["spectrum"][4, 0] == 4.0
+
+
+def test_recorder_scalar_rows_capped_by_chunk_size(tmp_path):
+    recorder = venusia_xnl_lib.Recorder(str(tmp_path / "scalars"), ["value"], [numpy.float64],
+                                        venusia_xnl_lib.RECORD_FORMAT_BINARY)
+    recorder.append([1.0])
+    assert recorder.chunk_rows == venusia_xnl_lib.RECORD_CHUNK_SIZE
+    recorder.close()
+
+
+def test_negative_cycles_run_no_iterations(tmp_path):
+    xml_file_path = write_experiment(tmp_path, [
+        variable_xml("n", "int_scalar", [-3]),
+        variable_xml("m", "int_scalar", [2]),
+        variable_xml("step", "float_spectrum", [1, 1]),
+        variable_xml("x", "float_scalar", [5]),
+        variable_xml("y", "float_scalar", [0]),
+        variable_xml("count", "int_scalar", [0]),
+    ], [
+        '<cycle var_name="x" cycles="n" step="step"><set_variable var_name="count" expression="count + 1"/></cycle>',
+        '<mesh><axis var_name="x" cycles="m" step="step"/><axis var_name="y" cycles="n" step="step"/>'
+        '<set_variable var_name="count" expression="count + 1"/></mesh>',
+    ], devices=())
+    experiment = run_experiment(xml_file_path, simulated_pool())
+    assert experiment.variables["count"].idata_value == 0
+    assert experiment.variables["x"].idata_value == 5.0
+    estimator = venusia_xnl_lib.Experiment().dry_run(xml_file_path)
+    assert estimator.estimated_s == 0.0
+
+
+def cycle_experiment(tmp_path, cycle_attributes, body):
+    return write_experiment(tmp_path, [
+        variable_xml("n", "int_scalar", [3]),
+        variable_xml("step", "int_spectrum", [1, 2]),
+        variable_xml("i", "int_scalar", [0]),
+        variable_xml("seen", "int_scalar", [0]),
+    ], ['<cycle var_name="i" cycles="n" step="step"%s><set_variable var_name="seen" expression="seen * 1000 + i"/>'
+        '%s</cycle>' % (cycle_attributes, body)], devices=())
+
+
+def test_scalar_cycle_steps_incrementally(tmp_path):
+    experiment = run_experiment(cycle_experiment(tmp_path, "", ""), simulated_pool())
+    # lo step spectrum si ripete: 0, 1, 3 e a fine ciclo 4
+    assert experiment.variables["seen"].idata_value == 1003
+    assert experiment.variables["i"].idata_value == 4
+    assert experiment.program[0].scan is False
+
+
+def test_scalar_cycle_body_writes_counter(tmp_path):
+    xml_file_path = cycle_experiment(tmp_path, "", '<set_variable var_name="i" expression="i + 100"/>')
+    experiment = run_experiment(xml_file_path, simulated_pool())
+    assert experiment.variables["seen"].idata_value == 101203
+
+
+def test_scan_cycle_follows_trajectory(tmp_path):
+    experiment = run_experiment(cycle_experiment(tmp_path, ' scan="true"', ""), simulated_pool())
+    assert experiment.variables["seen"].idata_value == 1003
+    assert experiment.variables["i"].idata_value == 4
+
+
+def test_scan_cycle_rejects_counter_writes(tmp_path):
+    xml_file_path = cycle_experiment(tmp_path, ' scan="true"', '<set_variable var_name="i" expression="i + 100"/>')
+    with pytest.raises(Exception, match="cannot be written inside the loop"):
+        run_experiment(xml_file_path, simulated_pool())
+
+
+def test_set_variable_spectrum_targets(tmp_path):
+    xml_file_path = write_experiment(tmp_path, [
+        variable_xml("sp", "float_spectrum", [1, 2, 3]),
+        variable_xml("copy", "float_spectrum", [0, 0]),
+        variable_xml("counts", "int_spectrum", [1, 2, 3]),
+        variable_xml("x", "float_scalar", [0]),
+    ], [
+        '<set_variable var_name="copy" expression="sp"/>',
+        '<set_variable var_name="sp" expression="0"/>',
+        '<set_variable var_name="counts" expression="counts * 2"/>',
+        '<set_variable var_name="x" expression="where(1 greater 0, 4.5, 0)"/>',
+    ], devices=())
+    experiment = run_experiment(xml_file_path, simulated_pool())
+    assert experiment.variables["sp"].idata_value.tolist() == [0.0, 0.0, 0.0]
+    assert experiment.variables["copy"].idata_value.tolist() == [1.0, 2.0, 3.0]
+    assert experiment.variables["counts"].idata_value.tolist() == [2, 4, 6]
+    assert experiment.variables["x"].idata_value == 4.5
+
+
+def cached_read_experiment(tmp_path, loop_body):
+    return write_experiment(tmp_path, [
+        variable_xml("n", "int_scalar", [5]),
+        variable_xml("i", "int_scalar", [0]),
+        variable_xml("step", "int_spectrum", [1, 1]),
+        variable_xml("gain_attr", "string_scalar", ["Gain"]),
+        variable_xml("gain", "int_scalar", [0]),
+    ], ['<cycle var_name="i" cycles="n" step="step">%s</cycle>' % loop_body],
+        devices=(), devices_xml='<device name="motor" tango_path="sim/motor/1"><cache attr="Gain" ttl="60"/></device>')
+
+
+def dry_run_calls(estimator):
+    return {(call["device"], call["attribute"], call["call"]): call["count"] for call in estimator.report()["calls"]}
+
+
+def test_dry_run_cached_reads(tmp_path):
+    read = '<read_attribute tango_device_name="motor" tango_attr_name="gain_attr" var_name="gain"/>'
+    estimator = venusia_xnl_lib.Experiment().dry_run(cached_read_experiment(tmp_path, read))
+    assert dry_run_calls(estimator) == {("motor", "Gain", "read_attribute"): 1, ("motor", "Gain", "cached_read"): 4}
+
+
+def test_dry_run_cached_reads_invalidated_by_writes(tmp_path):
+    body = ('<read_attribute tango_device_name="motor" tango_attr_name="gain_attr" var_name="gain"/>'
+            '<log message="between"/>'
+            '<write_attribute tango_device_name="motor" tango_attr_name="Gain" tango_attr_value="i"/>')
+    xml_file_path = cached_read_experiment(tmp_path, body)
+    estimator = venusia_xnl_lib.Experiment().dry_run(xml_file_path)
+    assert dry_run_calls(estimator) == {("motor", "Gain", "read_attribute"): 5, ("motor", "Gain", "write_attribute"): 5}
+    pool = simulated_pool({"Gain": 0})
+    run_experiment(xml_file_path, pool)
+    assert pool.get("sim/motor/1").calls["read_attribute"] == 5
+
+
+class CacheEventDeviceProxy(venusia_xnl_lib.SimulatedDeviceProxy):
+
+    # change event a comando; event_during_read simula un evento che arriva mentre la lettura e' in corso
+
+    def __init__(self, tango_path, attributes=None):
+        venusia_xnl_lib.SimulatedDeviceProxy.__init__(self, tango_path, attributes)
+        self.callback = None
+        self.event_during_read = None
+
+    def read_attribute(self, attr_name):
+        attribute = venusia_xnl_lib.SimulatedDeviceProxy.read_attribute(self, attr_name)
+        if self.event_during_read is not None:
+            self.push(self.event_during_read)
+            self.event_during_read = None
+        return attribute
+
+    def subscribe_event(self, attr_name, event_type, callback):
+        self.callback = callback
+        return 1
+
+    def unsubscribe_event(self, event_id):
+        self.callback = None
+
+    def push(self, value):
+        self.attributes["Position"] = value
+        self.callback(FakeEvent(value))
+
+
+def cached_reader(ttl=None):
+    cache = venusia_xnl_lib.AttributeCache()
+    cache.configure("motor", "Position", ttl)
+    device = CacheEventDeviceProxy("sim/motor/1", {"Position": 1.0})
+    return cache, device, cache.reader("motor", device, "Position")
+
+
+def test_attribute_cache_ttl_expiry():
+    cache, device, read = cached_reader(ttl=0.05)
+    assert [read(), read()] == [1.0, 1.0]
+    device.attributes["Position"] = 2.0
+    assert read() == 1.0
+    venusia_xnl_lib.time.sleep(0.06)
+    assert read() == 2.0
+    assert device.calls["read_attribute"] == 2
+    assert cache.stats() == {"hits": 2, "misses": 2,
+                             "attributes": {"motor/Position": {"hits": 2, "misses": 2, "invalidations": 0}}}
+
+
+def test_attribute_cache_event_refresh():
+    cache, device, read = cached_reader()
+    assert read() == 1.0
+    device.push(3.0)
+    assert [read(), read()] == [3.0, 3.0]
+    assert device.calls["read_attribute"] == 1
+    cache.close()
+    assert device.callback is None
+
+
+def test_attribute_cache_write_invalidation():
+    cache, device, read = cached_reader(ttl=60)
+    invalidate = cache.invalidator("motor")
+    assert cache.invalidator("other") is None
+    assert read() == 1.0
+    device.attributes["Position"] = 2.0
+    invalidate("Position")
+    assert read() == 2.0
+    assert cache.stats()["attributes"]["motor/Position"] == {"hits": 0, "misses": 2, "invalidations": 1}
+
+
+def test_attribute_cache_keeps_event_arrived_during_read():
+    cache, device, read = cached_reader()
+    assert read() == 1.0
+    cache.invalidator("motor")("Position")
+    # il device risponde 1.0 ma intanto un change event porta 2.0: la cache deve tenere il valore dell'evento
+    device.attributes["Position"] = 1.0
+    device.event_during_read = 2.0
+    assert read() == 1.0
+    assert [read(), read()] == [2.0, 2.0]
+    assert device.calls["read_attribute"] == 2
+
+
+def test_dry_run_conditions_on_loop_variables(tmp_path):
+    read = '<read_attribute tango_device_name="motor" tango_attr_name="gain_attr" var_name="gain"/>'
+    xml_file_path = write_experiment(tmp_path, [
+        variable_xml("n", "int_scalar", [10]),
+        variable_xml("i", "int_scalar", [0]),
+        variable_xml("five", "int_scalar", [5]),
+        variable_xml("step", "int_spectrum", [1, 1]),
+        variable_xml("gain_attr", "string_scalar", ["Gain"]),
+        variable_xml("gain", "int_scalar", [0]),
+        variable_xml("flag", "int_scalar", [0]),
+    ], ['<cycle var_name="i" cycles="n" step="step">'
+        '<if var1="i" operator="greater" var2="five">%s</if>'
+        '<set_variable var_name="flag" expression="flag + 1"/>'
+        '<if var1="flag" operator="greater" var2="five">%s</if>'
+        '</cycle>' % (read, read)])
+    estimator = venusia_xnl_lib.Experiment().dry_run(xml_file_path)
+    # i contatori e le variabili scritte nel ciclo non si valutano con i valori iniziali
+    assert dry_run_calls(estimator) == {("motor", "Gain", "read_attribute"): 20}
+    assert len(estimator.assumptions) == 2
+    pool = simulated_pool({"Gain": 0})
+    run_experiment(xml_file_path, pool)
+    assert pool.get("sim/motor/1").calls["read_attribute"] == 9
+
+
+def test_dry_run_while_simulation(tmp_path):
+    read = '<read_attribute tango_device_name="motor" tango_attr_name="gain_attr" var_name="gain"/>'
+    xml_file_path = write_experiment(tmp_path, [
+        variable_xml("k", "int_scalar", [0]),
+        variable_xml("three", "int_scalar", [3]),
+        variable_xml("gain_attr", "string_scalar", ["Gain"]),
+        variable_xml("gain", "int_scalar", [0]),
+    ], ['<while var1="k" operator="lesser" var2="three">%s<set_variable var_name="k" expression="k + 1"/></while>'
+        % read])
+    experiment = venusia_xnl_lib.Experiment()
+    estimator = experiment.dry_run(xml_file_path)
+    assert dry_run_calls(estimator) == {("motor", "Gain", "read_attribute"): 3}
+    assert estimator.assumptions == []
+    # la simulazione porta k a 3 e la stima del corpo non lo incrementa una volta di piu'
+    assert experiment.variables["k"].idata_value == 3
+
+
+def test_experiment_cache(tmp_path, monkeypatch):
+    xml_file_path = write_experiment(tmp_path, [variable_xml("counter", "int_scalar", [1])],
+                                     ['<set_variable var_name="counter" expression="counter + 1"/>'], devices=())
+    cache_dir = str(tmp_path / "cache")
+    key = venusia_xnl_lib.experiment_cache_key(xml_file_path)
+    assert run_experiment(xml_file_path, simulated_pool(), cache_dir=cache_dir).variables["counter"].idata_value == 2
+    assert os.listdir(cache_dir) == [key + venusia_xnl_lib.EXPERIMENT_CACHE_SUFFIX]
+    # una seconda esecuzione parte dai valori iniziali salvati, non da quelli modificati
+    assert run_experiment(xml_file_path, simulated_pool(), cache_dir=cache_dir).variables["counter"].idata_value == 2
+
+    monkeypatch.setattr(venusia_xnl_lib, "EXPERIMENT_CACHE_FORMAT", venusia_xnl_lib.EXPERIMENT_CACHE_FORMAT + 1)
+    assert venusia_xnl_lib.experiment_cache_key(xml_file_path) != key
+    monkeypatch.undo()
+    monkeypatch.setattr(venusia_xnl_lib, "library_digest", "changed source")
+    assert venusia_xnl_lib.experiment_cache_key(xml_file_path) != key
+
+
+class FailingDeviceProxy(venusia_xnl_lib.SimulatedDeviceProxy):
+
+    # i device "bad/..." rifiutano i comandi; Spectrum restituisce un array per membro
+
+    def command_inout(self, command_name, argin=None):
+        if self.tango_path.startswith("bad/"):
+            raise Exception("command %s refused" % command_name)
+        if command_name == "Spectrum":
+            return numpy.array([argin, argin])
+        return venusia_xnl_lib.SimulatedDeviceProxy.command_inout(self, command_name, argin)
+
+
+def group_experiment(tmp_path, operation):
+    return write_experiment(tmp_path, [
+        variable_xml("argin", "float_scalar", [0.5]),
+        variable_xml("gain", "int_scalar", [3]),
+        variable_xml("results", "float_spectrum", [0, 0]),
+        variable_xml("errors", "string_spectrum", ["", ""]),
+    ], [operation], devices=(("det1", "sim/det/1"), ("det2", "sim/det/2"), ("det3", "bad/det/3")),
+        devices_xml='<group name="detectors" members="det1, det2"><member device="det3"/></group>')
+
+
+def test_group_command_collects_results_and_errors(tmp_path):
+    xml_file_path = group_experiment(tmp_path, '<command_inout tango_group_name="detectors" tango_attr_name="Start"'
+                                               ' argin="argin" results="results" errors="errors"/>')
+    experiment = run_experiment(xml_file_path, simulated_pool(proxy_class=FailingDeviceProxy))
+    assert numpy.array_equal(experiment.variables["results"].idata_value, [0.5, 0.5, numpy.nan], equal_nan=True)
+    assert experiment.variables["errors"].idata_value.tolist() == ["", "", "command Start refused"]
+
+
+def test_group_command_raises_without_errors_variable(tmp_path):
+    xml_file_path = group_experiment(tmp_path, '<command_inout tango_group_name="detectors" tango_attr_name="Start"/>')
+    with pytest.raises(Exception, match="det3: command Start refused"):
+        run_experiment(xml_file_path, simulated_pool(proxy_class=FailingDeviceProxy))
+
+
+def test_group_command_rejects_spectrum_results(tmp_path):
+    xml_file_path = group_experiment(tmp_path, '<command_inout tango_group_name="detectors" tango_attr_name="Spectrum"'
+                                               ' argin="argin" results="results" errors="errors"/>')
+    with pytest.raises(Exception, match="returned a spectrum"):
+        run_experiment(xml_file_path, simulated_pool(proxy_class=FailingDeviceProxy))
+
+
+def test_group_write_rejects_results(tmp_path):
+    xml_file_path = group_experiment(tmp_path, '<write_attribute tango_group_name="detectors" tango_attr_name="Gain"'
+                                               ' tango_attr_value="gain" results="results"/>')
+    with pytest.raises(Exception, match="returns no results"):
+        run_experiment(xml_file_path, simulated_pool(proxy_class=FailingDeviceProxy))
+
+
+def test_group_write_fans_out(tmp_path):
+    xml_file_path = group_experiment(tmp_path, '<write_attribute tango_group_name="detectors" tango_attr_name="Gain"'
+                                               ' tango_attr_value="gain" errors="errors"/>')
+    pool = simulated_pool(proxy_class=FailingDeviceProxy)
+    experiment = run_experiment(xml_file_path, pool)
+    assert [pool.get(path).attributes["Gain"] for path in ("sim/det/1", "sim/det/2", "bad/det/3")] == [3, 3, 3]
+    assert experiment.variables["errors"].idata_value.tolist() == ["", "", ""]
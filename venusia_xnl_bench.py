@@ -0,0 +1,250 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+import venusia_xnl_lib
+
+
+BENCH_RESULTS_DIR = "bench_results"
+REGRESSION_THRESHOLD = 0.10
+
+
+def variable_xml(name, idata_type, values):
+    elements = "".join('<element value="%s"/>' % value for value in values)
+    return '<variable name="%s" type="%s">%s</variable>' % (name, idata_type, elements)
+
+
+def experiment_xml(variables, devices, operations):
+    return ("<experiment><variables>%s</variables><devices>%s</devices><operations>%s</operations></experiment>"
+            % ("".join(variables), "".join('<device name="%s" tango_path="%s"/>' % device for device in devices),
+               "".join(operations)))
+
+
+# ogni generatore restituisce (xml, attributi dei device simulati, iterazioni interne, operazioni eseguite)
+
+def deep_cycles(depth=4, cycles=10, counter_type="int_spectrum"):
+    variables = [variable_xml("n", "int_scalar", [cycles]),
+                 variable_xml("step", "int_spectrum", [1, 1]),
+                 variable_xml("position_attr", "string_scalar", ["Position"]),
+                 variable_xml("position", "float_scalar", [0])]
+    counter_value = [0, 0] if counter_type == "int_spectrum" else [0]
+    variables += [variable_xml("counter%d" % level, counter_type, counter_value) for level in range(depth)]
+    body = ('<read_attribute tango_device_name="motor" tango_attr_name="position_attr" var_name="position"/>'
+            '<write_attribute tango_device_name="motor" tango_attr_name="Position" tango_attr_value="1"/>')
+    operations = 2
+    for level in reversed(range(depth)):
+        body = '<cycle var_name="counter%d" cycles="n" step="step">%s</cycle>' % (level, body)
+        operations = 1 + cycles * operations
+    xml = experiment_xml(variables, [("motor", "sim/motor/1")], [body])
+    return xml, {"Position": 0.0}, cycles ** depth, operations
+
+
+def scalar_cycles(depth=4, cycles=10):
+    # contatori scalari: il percorso dei cicli annidati piu' comune, senza traiettoria
+    return deep_cycles(depth, cycles, "int_scalar")
+
+
+def large_variable_table(variables=5000, cycles=1000, conditions=10):
+    declarations = [variable_xml("n", "int_scalar", [cycles]),
+                    variable_xml("step", "int_spectrum", [1, 1]),
+                    variable_xml("counter", "int_spectrum", [0, 0])]
+    declarations += [variable_xml("v%d" % index, "float_scalar", [index]) for index in range(variables)]
+    stride = max(1, variables // conditions)
+    body = "".join('<if var1="v%d" operator="lesser" var2="v%d"></if>' % (index * stride, variables - 1 - index * stride)
+                   for index in range(conditions))
+    xml = experiment_xml(declarations, [], ['<cycle var_name="counter" cycles="n" step="step">%s</cycle>' % body])
+    return xml, {}, cycles, 1 + cycles * conditions
+
+
+def spectrum_reads(points=65536, cycles=1000):
+    variables = [variable_xml("n", "int_scalar", [cycles]),
+                 variable_xml("step", "int_spectrum", [1, 1]),
+                 variable_xml("counter", "int_spectrum", [0, 0]),
+                 variable_xml("spectrum_attr", "string_scalar", ["Spectrum"]),
+                 variable_xml("spectrum", "float_spectrum", [0, 0]),
+                 variable_xml("threshold", "float_scalar", [-1])]
+    body = ('<read_attribute tango_device_name="detector" tango_attr_name="spectrum_attr" var_name="spectrum"/>'
+            '<if var1="spectrum" operator="greater" var2="threshold">'
+            '<write_attribute tango_device_name="detector" tango_attr_name="Spectrum" tango_attr_value="spectrum"/>'
+            '</if>')
+    xml = experiment_xml(variables, [("detector", "sim/detector/1")],
+                         ['<cycle var_name="counter" cycles="n" step="step">%s</cycle>' % body])
+    return xml, {"Spectrum": numpy.arange(points, dtype=numpy.float64)}, cycles, 1 + cycles * 3
+
+
+def many_devices(devices=100, cycles=100):
+    variables = [variable_xml("n", "int_scalar", [cycles]),
+                 variable_xml("step", "int_spectrum", [1, 1]),
+                 variable_xml("counter", "int_spectrum", [0, 0]),
+                 variable_xml("value_attr", "string_scalar", ["Value"])]
+    variables += [variable_xml("value%d" % index, "float_scalar", [0]) for index in range(devices)]
+    body = "".join('<read_attribute tango_device_name="device%d" tango_attr_name="value_attr" var_name="value%d"/>'
+                   % (index, index) for index in range(devices))
+    xml = experiment_xml(variables, [("device%d" % index, "sim/device/%d" % index) for index in range(devices)],
+                         ['<cycle var_name="counter" cycles="n" step="step">%s</cycle>' % body])
+    return xml, {"Value": 1.0}, cycles, 1 + cycles * devices
+
+
+BENCHMARKS = {
+    "deep_cycles": deep_cycles,
+    "scalar_cycles": scalar_cycles,
+    "large_variable_table": large_variable_table,
+    "spectrum_reads": spectrum_reads,
+    "many_devices": many_devices,
+}
+
+
+def run_once(xml_file_path, factory):
+    pool = venusia_xnl_lib.ProxyPool(factory)
+    experiment = venusia_xnl_lib.Experiment(pool)
+    started = time.perf_counter()
+    experiment.load_xml(xml_file_path)
+    loaded = time.perf_counter()
+    try:
+        experiment.run()
+    finally:
+        experiment.close()
+    finished = time.perf_counter()
+    device_calls = sum(sum(connection.result().calls.values()) for connection in pool.connections.values())
+    return loaded - started, finished - loaded, device_calls
+
+
+def measure_memory(xml_file_path, factory):
+    pool = venusia_xnl_lib.ProxyPool(factory)
+    experiment = venusia_xnl_lib.Experiment(pool)
+    tracemalloc.start()
+    try:
+        experiment.load_xml(xml_file_path)
+        load_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        try:
+            experiment.run()
+        finally:
+            experiment.close()
+        run_peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return load_peak, run_peak
+
+
+def run_benchmark(name, latency=0.0, jitter=0.0, repeat=3):
+    xml, attributes, iterations, operations = BENCHMARKS[name]()
+    factory = venusia_xnl_lib.simulated_proxy_factory(attributes, latency, jitter, seed=0)
+    with tempfile.TemporaryDirectory() as directory:
+        xml_file_path = os.path.join(directory, name + ".xml")
+        with open(xml_file_path, "w") as xml_file:
+            xml_file.write(xml)
+        runs = [run_once(xml_file_path, factory) for _ in range(repeat)]
+        load_peak, run_peak = measure_memory(xml_file_path, factory)
+
+    # si tiene il migliore dei repeat, il meno disturbato dal resto della macchina
+    load_s = min(run[0] for run in runs)
+    run_s = min(run[1] for run in runs)
+    device_calls = runs[0][2]
+    return {
+        "iterations": iterations,
+        "operations": operations,
+        "device_calls": device_calls,
+        "xml_bytes": len(xml),
+        "load_s": load_s,
+        "run_s": run_s,
+        "ops_per_s": operations / run_s if run_s else None,
+        "iteration_us": run_s / iterations * 1e6,
+        # tempo per iterazione al netto della latenza simulata dei device
+        "iteration_overhead_us": max(0.0, run_s - device_calls * latency) / iterations * 1e6,
+        "load_peak_bytes": load_peak,
+        "run_peak_bytes": run_peak,
+    }
+
+
+def git_revision():
+    # revisione del sorgente misurato, None fuori da un checkout git
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(venusia_xnl_lib.__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def default_output(results):
+    # versione, revisione e ora: una misura non sovrascrive la precedente anche a versione invariata
+    parts = [results["version"], results["timestamp"].replace("-", "").replace(":", "")]
+    if results["revision"] is not None:
+        parts.append(results["revision"])
+    return os.path.join(BENCH_RESULTS_DIR, "%s.json" % "-".join(parts))
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD):
+    regressions = []
+    for name, result in results["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            continue
+        for metric in ("load_s", "run_s", "load_peak_bytes", "run_peak_bytes"):
+            previous = baseline["benchmarks"][name][metric]
+            if previous and result[metric] > previous * (1 + threshold):
+                regressions.append("%s %s: %.4g -> %.4g (+%.0f%%)"
+                                   % (name, metric, previous, result[metric], (result[metric] / previous - 1) * 100))
+    return regressions
+
+
+def format_results(results):
+    lines = ["%-22s %10s %10s %14s %14s %14s %14s" % ("benchmark", "load ms", "run ms", "ops/s", "iter us",
+                                                       "load peak KiB", "run peak KiB")]
+    for name, result in results["benchmarks"].items():
+        lines.append("%-22s %10.2f %10.2f %14.0f %14.2f %14.0f %14.0f"
+                     % (name, result["load_s"] * 1e3, result["run_s"] * 1e3, result["ops_per_s"] or 0,
+                        result["iteration_overhead_us"], result["load_peak_bytes"] / 1024.0,
+                        result["run_peak_bytes"] / 1024.0))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the venusia_xnl interpreter against simulated devices")
+    parser.add_argument("benchmarks", nargs="*", default=sorted(BENCHMARKS), help="benchmarks to run")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated device latency per call (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="simulated latency jitter (s)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="results file (default %s/<version>-<time>-<revision>.json)" % BENCH_RESULTS_DIR)
+    parser.add_argument("--baseline", help="previous results file to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "version": venusia_xnl_lib.__version__,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "latency": args.latency,
+        "jitter": args.jitter,
+        "benchmarks": {},
+    }
+    for name in args.benchmarks:
+        results["benchmarks"][name] = run_benchmark(name, args.latency, args.jitter, args.repeat)
+    print(format_results(results))
+
+    output = args.output or default_output(results)
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+    print("results saved to %s" % output)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file))
+        for regression in regressions:
+            print("REGRESSION %s" % regression)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
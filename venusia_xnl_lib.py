@@ -1,11 +1,44 @@
-from numpy import long
+import atexit
+import enum
+import hashlib
+import json
+import logging
+import logging.handlers
+import operator
+import os
+import pickle
+import queue
+import random
+import re
+import string
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import numpy
 from xml.etree import ElementTree
-from tango import DeviceProxy
 
+try:
+    from tango import DeviceProxy, DevState, EventType
+except ImportError:
+    # senza tango si lavora solo con device iniettati (ProxyPool(factory), SimulatedDeviceProxy)
+    DeviceProxy = None
+    DevState = enum.IntEnum("DevState", ["ON", "OFF", "CLOSE", "OPEN", "INSERT", "EXTRACT", "MOVING", "STANDBY",
+                                         "FAULT", "INIT", "RUNNING", "ALARM", "DISABLE", "UNKNOWN"], start=0)
+    DevState.names = dict(DevState.__members__)
+    EventType = enum.IntEnum("EventType", ["CHANGE_EVENT"], start=0)
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+__version__ = "0.2.0"
 
-# scalar internal types
-from tango._tango import DevState
 
+# scalar internal types
 IDATA_TYPE_INT_SCALAR = "int_scalar"
 IDATA_TYPE_LONG_SCALAR = "long_scalar"
 IDATA_TYPE_FLOAT_SCALAR = "float_scalar"
@@ -31,461 +64,3050 @@ OP_TAG_WHILE = "while"
 OP_TAG_IF = "if"
 OP_TAG_COMMAND_INOUT = "command_inout"
 OP_TAG_LOG = "log"
+OP_TAG_PARALLEL = "parallel"
+OP_TAG_WAIT_UNTIL = "wait_until"
+OP_TAG_RECORD = "record"
+OP_TAG_MESH = "mesh"
+
+# tags of the batched operations produced by batch_operations
+OP_TAG_READ_ATTRIBUTES = "read_attributes"
+OP_TAG_WRITE_ATTRIBUTES = "write_attributes"
+
+# wait_until polling bounds (seconds) when change events are not available
+WAIT_POLL_MIN_PERIOD = 0.01
+WAIT_POLL_MAX_PERIOD = 1.0
+
+# record storage
+RECORD_FORMAT_HDF5 = "hdf5"
+RECORD_FORMAT_BINARY = "binary"
+# a chunk holds at most RECORD_CHUNK_SIZE rows and at most RECORD_CHUNK_BYTES per column
+RECORD_CHUNK_SIZE = 256
+RECORD_CHUNK_BYTES = 1 << 20
+RECORD_BUFFER_COUNT = 4
+
+# dry run: default latency of each kind of tango call (s) when the model has nothing better
+DRY_RUN_LATENCIES = {
+    "read_attribute": 0.001,
+    "write_attribute": 0.001,
+    "read_attributes": 0.0015,
+    "write_attributes": 0.0015,
+    "command_inout": 0.001,
+    "cached_read": 0.0,
+}
+DRY_RUN_WHILE_ITERATIONS = 1
+DRY_RUN_WHILE_LIMIT = 100000
+DRY_RUN_HOT_SPOT_DEPTH = 2
+DRY_RUN_HOT_SPOT_FRACTION = 0.1
+
+# parsed experiment cache; bump EXPERIMENT_CACHE_FORMAT when the pickled layout changes
+EXPERIMENT_CACHE_SUFFIX = ".pickle"
+EXPERIMENT_CACHE_FORMAT = 2
 
 # lists
 OPERATORS = ["greater", "lesser", "equal","notequal","greaterequal","lesserequal"]
+OPERATOR_FUNCTIONS = {
+    "greater": operator.gt,
+    "lesser": operator.lt,
+    "equal": operator.eq,
+    "notequal": operator.ne,
+    "greaterequal": operator.ge,
+    "lesserequal": operator.le,
+}
+
+
+IDATA_TYPES = frozenset([IDATA_TYPE_STRING_SCALAR, IDATA_TYPE_FLOAT_SCALAR, IDATA_TYPE_INT_SCALAR, IDATA_TYPE_BOOLEAN_SCALAR,
+                         IDATA_TYPE_BOOLEAN_SPECTRUM, IDATA_TYPE_STRING_SPECTRUM, IDATA_TYPE_FLOAT_SPECTRUM,
+                         IDATA_TYPE_INT_SPECTRUM, IDATA_TYPE_STATE])
+
+# conversions from the xml "value" strings
+IDATA_SCALAR_CONVERTERS = {
+    IDATA_TYPE_INT_SCALAR: int,
+    IDATA_TYPE_FLOAT_SCALAR: float,
+    IDATA_TYPE_BOOLEAN_SCALAR: bool,
+    IDATA_TYPE_STRING_SCALAR: str,
+}
+IDATA_SPECTRUM_CONVERTERS = {
+    IDATA_TYPE_INT_SPECTRUM: int,
+    IDATA_TYPE_FLOAT_SPECTRUM: float,
+    IDATA_TYPE_BOOLEAN_SPECTRUM: bool,
+    IDATA_TYPE_STRING_SPECTRUM: str,
+}
+# spectrum variables are numpy arrays of these dtypes
+IDATA_SPECTRUM_DTYPES = {
+    IDATA_TYPE_INT_SPECTRUM: numpy.int64,
+    IDATA_TYPE_FLOAT_SPECTRUM: numpy.float64,
+    IDATA_TYPE_BOOLEAN_SPECTRUM: numpy.bool_,
+    IDATA_TYPE_STRING_SPECTRUM: object,
+}
+DEVSTATES = dict(DevState.names)
+# value stored in a group results spectrum for members whose call failed
+GROUP_MISSING_RESULTS = {
+    IDATA_TYPE_INT_SPECTRUM: 0,
+    IDATA_TYPE_FLOAT_SPECTRUM: numpy.nan,
+    IDATA_TYPE_BOOLEAN_SPECTRUM: False,
+    IDATA_TYPE_STRING_SPECTRUM: "",
+}
+
+# expression language of set_variable / if / while: operator -> (precedence, function)
+EXPRESSION_BINARY_OPERATORS = {
+    "or": (1, numpy.logical_or),
+    "and": (2, numpy.logical_and),
+    "<": (4, operator.lt),
+    "<=": (4, operator.le),
+    ">": (4, operator.gt),
+    ">=": (4, operator.ge),
+    "==": (4, operator.eq),
+    "!=": (4, operator.ne),
+    "+": (5, operator.add),
+    "-": (5, operator.sub),
+    "*": (6, operator.mul),
+    "/": (6, operator.truediv),
+    "//": (6, operator.floordiv),
+    "%": (6, operator.mod),
+    "**": (8, operator.pow),
+}
+# i nomi degli operatori delle condizioni valgono anche nelle espressioni, comodi dentro gli attributi xml
+EXPRESSION_BINARY_OPERATORS.update((operator_name, (4, OPERATOR_FUNCTIONS[operator_name])) for operator_name in OPERATORS)
+EXPRESSION_UNARY_OPERATORS = {
+    "-": operator.neg,
+    "+": operator.pos,
+    "not": numpy.logical_not,
+}
+# function name -> {number of arguments: function}
+EXPRESSION_FUNCTIONS = {
+    "abs": {1: numpy.abs},
+    "sqrt": {1: numpy.sqrt},
+    "exp": {1: numpy.exp},
+    "log": {1: numpy.log},
+    "log10": {1: numpy.log10},
+    "sin": {1: numpy.sin},
+    "cos": {1: numpy.cos},
+    "floor": {1: numpy.floor},
+    "ceil": {1: numpy.ceil},
+    "round": {1: numpy.round},
+    "min": {1: numpy.min, 2: numpy.minimum},
+    "max": {1: numpy.max, 2: numpy.maximum},
+    "sum": {1: numpy.sum},
+    "mean": {1: numpy.mean},
+    "any": {1: numpy.any},
+    "all": {1: numpy.all},
+    "len": {1: numpy.size},
+    "clip": {3: numpy.clip},
+    "where": {3: numpy.where},
+}
+EXPRESSION_CONSTANTS = {"true": True, "false": False, "pi": numpy.pi}
+EXPRESSION_TOKEN = re.compile(r"\s*(?:(\d+\.\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?|\d+(?:[eE][-+]?\d+)?)"
+                              r"|([A-Za-z_]\w*(?:\[\d+\])?)|(\*\*|//|<=|>=|==|!=|[-+*/%<>(),]))")
+
+
+class VariableStore:
+
+    __slots__ = ("values", "slots")
+
+    def __init__(self):
+        # i valori di tutte le variabili stanno in una sola lista, indicizzata dallo slot
+        self.values = []
+        self.slots = {}
+
+    def allocate(self, idata_name, idata_value):
+        if idata_name in self.slots:
+            raise Exception("Variable %s already declared" % idata_name)
+        slot = len(self.values)
+        self.values.append(idata_value)
+        self.slots[idata_name] = slot
+        return slot
 
 
 class InternalData:
 
-    def __init__(self, idata_name, idata_value, idata_type):
+    __slots__ = ("idata_name", "idata_type", "idata_slot", "store")
+
+    def __init__(self, idata_name, idata_value, idata_type, store=None):
+
+        if idata_type not in IDATA_TYPES:
+            raise Exception("Internal data type error")
 
         self.idata_name = idata_name
         self.idata_type = idata_type
-        self.idata_value = None
-
-        if "spectrum" not in idata_type:
-
-            if self.idata_type == IDATA_TYPE_INT_SCALAR:
-                self.idata_value = int(idata_value[0])
-            elif self.idata_type == IDATA_TYPE_FLOAT_SCALAR:
-                self.idata_value = float(idata_value[0])
-            elif self.idata_type == IDATA_TYPE_BOOLEAN_SCALAR:
-                self.idata_value = bool(idata_value[0])
-            elif self.idata_type == IDATA_TYPE_STRING_SCALAR:
-                self.idata_value = idata_value[0]
-            elif self.idata_type == IDATA_TYPE_STATE:
-                if idata_value[0] == "ON":
-                    self.idata_value = DevState.ON
-                elif idata_value[0] == "OFF":
-                    self.idata_value = DevState.OFF
-                elif idata_value[0] == "CLOSE":
-                    self.idata_value = DevState.CLOSE
-                elif idata_value[0] == "OPEN":
-                    self.idata_value = DevState.OPEN
-                elif idata_value[0] == "INSERT":
-                    self.idata_value = DevState.INSERT
-                elif idata_value[0] == "EXTRACT":
-                    self.idata_value = DevState.EXTRACT
-                elif idata_value[0] == "MOVING":
-                    self.idata_value = DevState.MOVING
-                elif idata_value[0] == "STANDBY":
-                    self.idata_value = DevState.STANDBY
-                elif idata_value[0] == "FAULT":
-                    self.idata_value = DevState.FAULT
-                elif idata_value[0] == "INIT":
-                    self.idata_value = DevState.INIT
-                elif idata_value[0] == "RUNNING":
-                    self.idata_value = DevState.RUNNING
-                elif idata_value[0] == "ALARM":
-                    self.idata_value = DevState.ALARM
-                elif idata_value[0] == "DISABLE":
-                    self.idata_value = DevState.DISABLE
-                elif idata_value[0] == "UNKNOWN":
-                    self.idata_value = DevState.UNKNOWN
-                else:
-                    raise Exception("Invalid devstate of %s variable. Allowed values are %s" % (idata_name, DevState.names))
-
-        #----------------------- idata tipo Spectrum -------------------------------------------------------------------
-
+        self.store = store if store is not None else VariableStore()
+
+        if idata_type in IDATA_SCALAR_CONVERTERS:
+            value = IDATA_SCALAR_CONVERTERS[idata_type](idata_value[0])
+        elif idata_type == IDATA_TYPE_STATE:
+            if idata_value[0] not in DEVSTATES:
+                raise Exception("Invalid devstate of %s variable. Allowed values are %s" % (idata_name, DevState.names))
+            value = DEVSTATES[idata_value[0]]
         else:
-            self.idata_value = []
-            for each in idata_value:
-                if self.idata_type == IDATA_TYPE_INT_SPECTRUM:
-                    self.idata_value.append(int(each))
-                elif self.idata_type == IDATA_TYPE_FLOAT_SPECTRUM:
-                    self.idata_value.append(float(each))
-                elif self.idata_type == IDATA_TYPE_STRING_SPECTRUM:
-                     self.idata_value.append(each)
-                elif self.idata_type == IDATA_TYPE_BOOLEAN_SPECTRUM:
-                    self.idata_value.append(bool(each))
-                else:
-                    raise Exception("idata_type %s not allowed" % idata_type)
-                    pass
-
-    @property
-    def idata_name(self):
-        return self._idata_name
+            converter = IDATA_SPECTRUM_CONVERTERS[idata_type]
+            value = numpy.array([converter(each) for each in idata_value], dtype=IDATA_SPECTRUM_DTYPES[idata_type])
 
-    @idata_name.setter
-    def idata_name(self, idata_name):
-        self._idata_name = idata_name
+        self.idata_slot = self.store.allocate(idata_name, value)
 
     @property
     def idata_value(self):
-        return self._idata_value
+        return self.store.values[self.idata_slot]
 
     @idata_value.setter
     def idata_value(self, idata_value):
-        self._idata_value = idata_value
-
-    @property
-    def idata_type(self):
-        return self._idata_type
-
-    @idata_type.setter
-    def idata_type(self, idata_type):
-        if idata_type not in [IDATA_TYPE_STRING_SCALAR, IDATA_TYPE_FLOAT_SCALAR, IDATA_TYPE_INT_SCALAR, IDATA_TYPE_BOOLEAN_SCALAR, IDATA_TYPE_BOOLEAN_SPECTRUM, IDATA_TYPE_STRING_SPECTRUM, IDATA_TYPE_FLOAT_SPECTRUM, IDATA_TYPE_INT_SPECTRUM, IDATA_TYPE_STATE]:
-            raise Exception("Internal data type error")
-        else:
-            self._idata_type = idata_type
-
-
-class Experiment:
+        self.store.values[self.idata_slot] = idata_value
+
+
+def restore_variables(names, types, values):
+    # ricostruisce store e variabili da una tabella gia' convertita, senza ripassare dai converter
+    store = VariableStore()
+    store.values = values
+    store.slots = {idata_name: slot for slot, idata_name in enumerate(names)}
+    variables = {}
+    for slot, (idata_name, idata_type) in enumerate(zip(names, types)):
+        idata = InternalData.__new__(InternalData)
+        idata.idata_name = idata_name
+        idata.idata_type = idata_type
+        idata.idata_slot = slot
+        idata.store = store
+        variables[idata_name] = idata
+    return store, variables
+
+
+def spectrum_coercer(idata_type):
+    dtype = numpy.dtype(IDATA_SPECTRUM_DTYPES[idata_type])
+
+    # gli array che arrivano da tango vengono tenuti cosi' come sono se sono gia' del tipo giusto
+    def coerce(value):
+        value = numpy.asarray(value)
+        if value.dtype.kind != dtype.kind:
+            value = value.astype(dtype)
+        return value
+    return coerce
+
+
+def spectrum_comparator(operator_name):
+    compare = OPERATOR_FUNCTIONS[operator_name]
+    if operator_name == "notequal":
+        return lambda value1, value2: bool(numpy.any(compare(value1, value2)))
+    return lambda value1, value2: bool(numpy.all(compare(value1, value2)))
+
+
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+
+logger = logging.getLogger(__name__)
+log_listener = None
+# serializza la configurazione: con ExperimentScheduler piu' thread fanno il link insieme
+logging_lock = threading.RLock()
+
+
+class MessageTemplate:
+
+    def __init__(self, message):
+        self.message = message
+        # il formato viene analizzato una volta sola: (testo, indice parametro, conversione, format_spec)
+        self.pieces = []
+        auto_index = 0
+        for literal, field_name, format_spec, conversion in string.Formatter().parse(message):
+            if field_name is None:
+                self.pieces.append((literal, None, None, None))
+                continue
+            if field_name == "":
+                parameter_index = auto_index
+                auto_index += 1
+            elif field_name.isdigit():
+                parameter_index = int(field_name)
+            else:
+                # campi con attributi o chiavi: si lascia fare a str.format
+                self.pieces = None
+                return
+            self.pieces.append((literal, parameter_index, conversion, format_spec))
+
+    def render(self, parameters):
+        if self.pieces is None:
+            return self.message.format(*parameters)
+        rendered = []
+        for literal, parameter_index, conversion, format_spec in self.pieces:
+            rendered.append(literal)
+            if parameter_index is None:
+                continue
+            value = parameters[parameter_index]
+            if conversion == "r":
+                value = repr(value)
+            elif conversion == "s":
+                value = str(value)
+            elif conversion == "a":
+                value = ascii(value)
+            rendered.append(format(value, format_spec))
+        return "".join(rendered)
+
+
+class LogMessage:
+
+    __slots__ = ("template", "parameters")
+
+    def __init__(self, template, parameters):
+        self.template = template
+        self.parameters = parameters
+
+    def __str__(self):
+        return self.template.render(self.parameters)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # il messaggio viene formattato dal thread del sink, non nel ciclo dell'esperimento
+        return record
+
+
+def configure_logging(level=logging.INFO, stream=None, quiet=False, log_format=LOG_FORMAT):
+    global log_listener
+    with logging_lock:
+        stop_logging()
+        if quiet:
+            level = logging.WARNING
+
+        log_queue = queue.SimpleQueue()
+        sink = logging.StreamHandler(stream)
+        sink.setFormatter(logging.Formatter(log_format))
+        log_listener = logging.handlers.QueueListener(log_queue, sink)
+        log_listener.start()
+
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(DeferredQueueHandler(log_queue))
+        logger.setLevel(level)
+        logger.propagate = False
+        return log_listener
+
+
+def configure_default_logging():
+    # nessuna configurazione dall'applicazione: i <log> vanno su stdout come messaggi semplici, come prima
+    with logging_lock:
+        if logger.hasHandlers():
+            return
+        configure_logging(stream=sys.stdout, log_format="%(message)s")
+        atexit.register(stop_logging)
+
+
+def stop_logging():
+    # svuota la coda e ferma il thread del sink
+    global log_listener
+    with logging_lock:
+        if log_listener is not None:
+            log_listener.stop()
+            log_listener = None
+
+
+class ProxyPool:
+
+    def __init__(self, factory=None):
+        # factory=None usa DeviceProxy; per i test si puo' passare un costruttore finto
+        self.factory = factory
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def connect(self, tango_path):
+        # ogni device si connette nel suo thread, cosi' un device lento non blocca gli altri
+        with self.lock:
+            if tango_path in self.connections:
+                return self.connections[tango_path]
+            connection = Future()
+            self.connections[tango_path] = connection
+
+        def create_proxy():
+            factory = self.factory if self.factory is not None else DeviceProxy
+            try:
+                if factory is None:
+                    raise Exception("tango is not installed and no proxy factory was given")
+                connection.set_result(factory(tango_path))
+            except BaseException as exception:
+                # un tentativo fallito non resta nel pool, il prossimo connect riprova
+                with self.lock:
+                    if self.connections.get(tango_path) is connection:
+                        del self.connections[tango_path]
+                connection.set_exception(exception)
+
+        threading.Thread(target=create_proxy, name="connect %s" % tango_path, daemon=True).start()
+        return connection
+
+    def get(self, tango_path, connect_timeout=None):
+        try:
+            return self.connect(tango_path).result(connect_timeout)
+        except FutureTimeoutError:
+            raise Exception("Timeout connecting to device %s after %s s" % (tango_path, connect_timeout))
+
+    def get_all(self, tango_paths, connect_timeouts):
+        connections = [self.connect(tango_path) for tango_path in tango_paths]
+        started = time.monotonic()
+        proxies = []
+        errors = []
+        for tango_path, connection, connect_timeout in zip(tango_paths, connections, connect_timeouts):
+            # i timeout partono tutti insieme, non uno dopo l'altro
+            if connect_timeout is not None:
+                connect_timeout = max(0.0, started + connect_timeout - time.monotonic())
+            try:
+                proxies.append(connection.result(connect_timeout))
+            except FutureTimeoutError:
+                errors.append("%s: connection timeout" % tango_path)
+            except Exception as exception:
+                errors.append("%s: %s" % (tango_path, exception))
+        if errors:
+            raise Exception("Cannot connect to devices: %s" % "; ".join(errors))
+        return proxies
+
+    def lazy(self, tango_path, connect_timeout=None):
+        return LazyDeviceProxy(self, tango_path, connect_timeout)
+
+    def clear(self):
+        with self.lock:
+            self.connections.clear()
+
+
+class LazyDeviceProxy:
+
+    def __init__(self, pool, tango_path, connect_timeout=None):
+        self.pool = pool
+        self.tango_path = tango_path
+        self.connect_timeout = connect_timeout
+
+    def __getattr__(self, name):
+        # al primo uso ci si connette; i metodi risolti restano nell'istanza e non ripassano di qui
+        attribute = getattr(self.pool.get(self.tango_path, self.connect_timeout), name)
+        if callable(attribute):
+            self.__dict__[name] = attribute
+        return attribute
+
+
+# process-wide pool: Experiment instances share connections by tango_path
+PROXY_POOL = ProxyPool()
+
+
+class AttributeCache:
 
     def __init__(self):
-        self.variables = {}
-        self.devices = {}
-
-    def parse_xml(self, xml_file_path):
-        xml_tree = ElementTree.parse(xml_file_path)
-        xml_root = xml_tree.getroot()
-
-        variable_nodes = xml_root.findall("variables")[0].findall("variable")
-        for variable_node in variable_nodes:
-            current_idata_name = variable_node.attrib["name"]
-            current_idata_type = variable_node.attrib["type"]
-            current_idata_value = []
-
-            element_nodes = variable_node.findall("element")
-
-            for element_node in element_nodes:
-                current_idata_value.append(element_node.attrib["value"])
-
-            if "scalar" in current_idata_type and not len(current_idata_value) == 1:
-                raise Exception("Incorrect value %s for idata_type %s" % (current_idata_value, current_idata_type))
-                pass
-            if "state" in current_idata_type and not len(current_idata_value) == 1:
-                raise Exception("Incorrect value %s for idata_type %s" % (current_idata_value, current_idata_type))
-                pass
-            elif "spectrum" in current_idata_type and len(current_idata_value) == 1:
-                raise Exception("Incorrect value %s for idata_type %s" % (current_idata_value, current_idata_type))
-                pass
+        # (device_name, attr_name) -> ttl in secondi, oppure None = valido fino al prossimo change event
+        self.policies = {}
+        # (device_name, attr_name) -> [valore, scadenza]
+        self.entries = {}
+        # (device_name, attr_name) -> [hits, misses, invalidations]
+        self.counters = {}
+        # (device_name, attr_name) -> generazione, cresce a ogni evento o invalidazione
+        self.generations = {}
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+
+    def configure(self, device_name, attr_name, ttl=None):
+        self.policies[(device_name, attr_name)] = ttl
+        self.counters[(device_name, attr_name)] = [0, 0, 0]
+        self.generations[(device_name, attr_name)] = 0
+
+    def is_cached(self, device_name, attr_name):
+        return (device_name, attr_name) in self.policies
+
+    def reader(self, device_name, device, attr_name):
+        key = (device_name, attr_name)
+        ttl = self.policies[key]
+        entries = self.entries
+        counters = self.counters[key]
+        generations = self.generations
+        lock = self.lock
+
+        def read():
+            entry = entries.get(key)
+            if entry is not None and time.monotonic() < entry[1]:
+                counters[0] += 1
+                value = entry[0]
+                # una copia, cosi' chi modifica la variabile non sporca la cache
+                return value.copy() if isinstance(value, numpy.ndarray) else value
+            counters[1] += 1
+            generation = generations[key]
+            value = device.read_attribute(attr_name).value
+            if ttl is not None or self.subscribe(key, device):
+                with lock:
+                    # un evento o una scrittura arrivati durante la lettura sono piu' recenti: si tiene la loro voce
+                    if generations[key] == generation:
+                        entries[key] = [value, time.monotonic() + ttl if ttl is not None else float("inf")]
+            return value.copy() if isinstance(value, numpy.ndarray) else value
+        return read
+
+    def subscribe(self, key, device):
+        if key not in self.subscriptions:
+            def push_event(event):
+                with self.lock:
+                    self.generations[key] += 1
+                    if event.err:
+                        self.entries.pop(key, None)
+                    else:
+                        self.entries[key] = [event.attr_value.value, float("inf")]
+            try:
+                self.subscriptions[key] = (device, device.subscribe_event(key[1], EventType.CHANGE_EVENT, push_event))
+            except Exception:
+                # senza eventi l'attributo non si puo' tenere in cache: si legge sempre dal device
+                logger.warning("Change events not available for %s/%s, attribute not cached" % key)
+                self.subscriptions[key] = None
+        return self.subscriptions[key] is not None
+
+    def invalidator(self, device_name):
+        # None se il device non ha attributi in cache, cosi' le write non pagano nulla
+        if not any(cached_device_name == device_name for cached_device_name, _ in self.policies):
+            return None
+
+        def invalidate(attr_name):
+            key = (device_name, attr_name)
+            if key in self.policies:
+                with self.lock:
+                    self.generations[key] += 1
+                    if self.entries.pop(key, None) is not None:
+                        self.counters[key][2] += 1
+        return invalidate
+
+    def stats(self):
+        hits = sum(counter[0] for counter in self.counters.values())
+        misses = sum(counter[1] for counter in self.counters.values())
+        return {"hits": hits, "misses": misses,
+                "attributes": {"%s/%s" % key: {"hits": counter[0], "misses": counter[1], "invalidations": counter[2]}
+                               for key, counter in self.counters.items()}}
+
+    def close(self):
+        for subscription in self.subscriptions.values():
+            if subscription is not None:
+                device, event_id = subscription
+                device.unsubscribe_event(event_id)
+        self.subscriptions.clear()
+        self.entries.clear()
+
+
+class SimulatedAttribute:
+
+    __slots__ = ("name", "value")
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+
+class SimulatedDeviceProxy:
+
+    def __init__(self, tango_path, attributes=None, latency=0.0, jitter=0.0, connect_latency=0.0, seed=None):
+        # device in-process: ogni chiamata costa latency +/- jitter secondi, gli attributi sono un dizionario
+        self.tango_path = tango_path
+        self.attributes = dict(attributes) if attributes is not None else {}
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.timeout_millis = None
+        self.simulate_latency(connect_latency, 0.0)
+
+    def simulate_latency(self, latency, jitter):
+        if jitter:
+            latency += self.random.uniform(-jitter, jitter)
+        if latency > 0:
+            time.sleep(latency)
+
+    def count(self, call):
+        self.calls[call] = self.calls.get(call, 0) + 1
+        self.simulate_latency(self.latency, self.jitter)
+
+    def attribute(self, attr_name):
+        if attr_name not in self.attributes:
+            raise Exception("Attribute %s not found on simulated device %s" % (attr_name, self.tango_path))
+        value = self.attributes[attr_name]
+        # come tango, ogni lettura restituisce un array nuovo
+        if isinstance(value, numpy.ndarray):
+            value = value.copy()
+        return SimulatedAttribute(attr_name, value)
+
+    def read_attribute(self, attr_name):
+        self.count("read_attribute")
+        return self.attribute(attr_name)
+
+    def read_attributes(self, attr_names):
+        self.count("read_attributes")
+        return [self.attribute(attr_name) for attr_name in attr_names]
+
+    def write_attribute(self, attr_name, value):
+        self.count("write_attribute")
+        self.attributes[attr_name] = numpy.array(value) if isinstance(value, numpy.ndarray) else value
+
+    def write_attributes(self, name_values):
+        self.count("write_attributes")
+        for attr_name, value in name_values:
+            self.attributes[attr_name] = numpy.array(value) if isinstance(value, numpy.ndarray) else value
+
+    def command_inout(self, command_name, argin=None):
+        self.count("command_inout")
+        return argin
+
+    def set_timeout_millis(self, timeout_millis):
+        self.timeout_millis = timeout_millis
+
+    def subscribe_event(self, attr_name, event_type, callback):
+        # nessun evento configurato: wait_until passa al polling
+        raise Exception("Events not configured for %s/%s" % (self.tango_path, attr_name))
+
+
+def simulated_proxy_factory(attributes=None, latency=0.0, jitter=0.0, connect_latency=0.0, seed=None):
+    # attributes: {tango_path: {attr_name: value}} oppure {attr_name: value} uguale per tutti i device
+    def factory(tango_path):
+        device_attributes = attributes
+        if attributes is not None and tango_path in attributes:
+            device_attributes = attributes[tango_path]
+        return SimulatedDeviceProxy(tango_path, device_attributes, latency, jitter, connect_latency, seed)
+    return factory
+
+
+class Hdf5RecordFile:
+
+    def __init__(self, path, chunk_size):
+        self.file = h5py.File(path, "a")
+        self.chunk_size = chunk_size
+        self.datasets = {}
+
+    def append(self, name, chunk):
+        if name not in self.datasets:
+            if name in self.file:
+                self.datasets[name] = self.file[name]
             else:
-                current_idata = InternalData(current_idata_name, current_idata_value, current_idata_type)
-                self.variables[current_idata_name] = current_idata
-
-        device_nodes = xml_root.findall("devices")[0].findall("device")
-        for device_node in device_nodes:
-            current_device_name = device_node.attrib["name"]
-            current_device_tango_path = device_node.attrib["tango_path"]
-            current_device_proxy = DeviceProxy(current_device_tango_path)
-            self.devices[current_device_name] = current_device_proxy
+                self.datasets[name] = self.file.create_dataset(name, shape=(0,) + chunk.shape[1:], dtype=chunk.dtype,
+                                                               maxshape=(None,) + chunk.shape[1:],
+                                                               chunks=(self.chunk_size,) + chunk.shape[1:])
+        dataset = self.datasets[name]
+        rows = dataset.shape[0]
+        dataset.resize(rows + len(chunk), axis=0)
+        dataset[rows:] = chunk
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class BinaryRecordFile:
+
+    def __init__(self, path):
+        # una directory, un file .bin per colonna (leggibile con numpy.memmap) e un .json con dtype/shape
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.columns = {}
+
+    def append(self, name, chunk):
+        if name not in self.columns:
+            header_path = os.path.join(self.path, name + ".json")
+            rows = 0
+            if os.path.exists(header_path):
+                with open(header_path) as header_file:
+                    rows = json.load(header_file)["rows"]
+            self.columns[name] = {"file": open(os.path.join(self.path, name + ".bin"), "ab"), "rows": rows,
+                                  "dtype": chunk.dtype.str, "shape": list(chunk.shape[1:])}
+        column = self.columns[name]
+        column["file"].write(numpy.ascontiguousarray(chunk).tobytes())
+        column["rows"] += len(chunk)
+
+    def flush(self):
+        for name, column in self.columns.items():
+            column["file"].flush()
+            with open(os.path.join(self.path, name + ".json"), "w") as header_file:
+                json.dump({"dtype": column["dtype"], "shape": column["shape"], "rows": column["rows"]}, header_file)
+
+    def close(self):
+        self.flush()
+        for column in self.columns.values():
+            column["file"].close()
+
+
+def load_record(path):
+    if h5py is not None and os.path.isfile(path):
+        with h5py.File(path, "r") as record_file:
+            return {name: record_file[name][()] for name in record_file}
+    record = {}
+    for file_name in sorted(os.listdir(path)):
+        if file_name.endswith(".json"):
+            name = file_name[:-len(".json")]
+            with open(os.path.join(path, file_name)) as header_file:
+                header = json.load(header_file)
+            shape = (header["rows"],) + tuple(header["shape"])
+            if header["rows"] == 0:
+                record[name] = numpy.empty(shape, dtype=header["dtype"])
+            else:
+                record[name] = numpy.memmap(os.path.join(path, name + ".bin"), dtype=header["dtype"], mode="r", shape=shape)
+    return record
+
+
+class Recorder:
+
+    def __init__(self, path, names, dtypes, record_format=None, chunk_size=RECORD_CHUNK_SIZE,
+                 buffer_count=RECORD_BUFFER_COUNT, chunk_bytes=RECORD_CHUNK_BYTES):
+        if record_format is None:
+            record_format = RECORD_FORMAT_HDF5 if h5py is not None else RECORD_FORMAT_BINARY
+        if record_format == RECORD_FORMAT_HDF5 and h5py is None:
+            raise Exception("Record format %s requires h5py" % record_format)
+        if record_format not in (RECORD_FORMAT_HDF5, RECORD_FORMAT_BINARY):
+            raise Exception("Record format %s not recognized" % record_format)
+        self.path = path
+        self.names = names
+        self.dtypes = dtypes
+        self.record_format = record_format
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        # righe per chunk, fissate alla prima riga quando si conosce la dimensione degli spectrum
+        self.chunk_rows = None
+        self.buffer_count = buffer_count
+
+        # i chunk pieni passano al writer; al massimo buffer_count chunk esistono, quindi la memoria resta fissa
+        self.buffers_allocated = 0
+        self.free_buffers = queue.Queue()
+        self.full_buffers = queue.Queue()
+        self.buffer = None
+        self.row = 0
+        self.error = None
+        self.writer = threading.Thread(target=self.write_chunks, name="record %s" % path, daemon=True)
+        self.writer.start()
+
+    def append(self, values):
+        if self.error is not None:
+            raise Exception("Recorder %s failed: %s" % (self.path, self.error))
+        if self.buffer is None:
+            self.buffer = self.take_buffer(values)
+        row = self.row
+        for column, value in zip(self.buffer, values):
+            column[row] = value
+        self.row = row + 1
+        if self.row == self.chunk_rows:
+            self.full_buffers.put((self.buffer, self.row))
+            self.buffer = None
+            self.row = 0
+
+    def take_buffer(self, values):
+        if self.chunk_rows is None:
+            self.chunk_rows = self.rows_per_chunk(values)
+        if self.buffers_allocated < self.buffer_count:
+            self.buffers_allocated += 1
+            return [numpy.empty((self.chunk_rows,) + numpy.shape(value), dtype=dtype)
+                    for value, dtype in zip(values, self.dtypes)]
+        buffer = self.free_buffers.get()
+        if buffer is None:
+            self.free_buffers.put(None)
+            raise Exception("Recorder %s failed: %s" % (self.path, self.error))
+        return buffer
+
+    def rows_per_chunk(self, values):
+        # uno spectrum da 64k float sono 512 KiB a riga: il limite in byte tiene piccoli chunk e buffer
+        row_bytes = max(numpy.dtype(dtype).itemsize * int(numpy.prod(numpy.shape(value)))
+                        for value, dtype in zip(values, self.dtypes)) if values else 0
+        if row_bytes == 0:
+            return self.chunk_size
+        return max(1, min(self.chunk_size, self.chunk_bytes // row_bytes))
+
+    def write_chunks(self):
+        record_file = None
+        try:
+            while True:
+                item = self.full_buffers.get()
+                if item is None:
+                    break
+                buffer, rows = item
+                if record_file is None:
+                    if self.record_format == RECORD_FORMAT_HDF5:
+                        record_file = Hdf5RecordFile(self.path, self.chunk_rows)
+                    else:
+                        record_file = BinaryRecordFile(self.path)
+                for name, column in zip(self.names, buffer):
+                    record_file.append(name, column[:rows])
+                record_file.flush()
+                self.free_buffers.put(buffer)
+        except Exception as exception:
+            self.error = exception
+            # sblocca append() in attesa di un buffer libero
+            self.free_buffers.put(None)
+        finally:
+            if record_file is not None:
+                record_file.close()
+
+    def close(self):
+        if self.buffer is not None and self.row > 0:
+            self.full_buffers.put((self.buffer, self.row))
+        self.buffer = None
+        self.row = 0
+        self.full_buffers.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise Exception("Recorder %s failed: %s" % (self.path, self.error))
+
+
+class Validator:
+
+    def __init__(self, variables, device_names, group_names=()):
+        self.variables = variables
+        self.device_names = device_names
+        self.group_names = group_names
+        self.record_paths = set()
+        self.errors = []
+
+    def error(self, message):
+        self.errors.append(message)
+
+    def variable(self, var_name, text=None):
+        # restituisce la variabile o None, registrando l'errore una volta sola
+        if var_name not in self.variables:
+            self.error("Variable %s not in Experiment dictionary" % (text if text is not None else var_name))
+            return None
+        return self.variables[var_name]
+
+    def device(self, tango_device_name):
+        if tango_device_name not in self.device_names:
+            self.error("device_name %s not in devices dicionary" % tango_device_name)
+
+    def group(self, tango_group_name):
+        if tango_group_name not in self.group_names:
+            self.error("group_name %s not in device groups" % tango_group_name)
+
+    def attr_name_variable(self, attr_name_variable):
+        idata = self.variable(attr_name_variable)
+        if idata is not None and idata.idata_type != IDATA_TYPE_STRING_SCALAR:
+            self.error("Variable %s holding a tango attribute name must be %s" % (attr_name_variable, IDATA_TYPE_STRING_SCALAR))
+
+    def check(self):
+        if self.errors:
+            raise Exception("Experiment validation failed:\n  %s" % "\n  ".join(self.errors))
+
+
+class Constant:
+
+    def __init__(self, value):
+        self.value = value
+        self.text = str(value)
+
+    def validate(self, validator):
+        pass
+
+    def link(self, experiment):
+        pass
+
+    def get(self):
+        return self.value
+
+
+class Operand:
+
+    def __init__(self, operand_text):
+        self.text = operand_text
+        self.name, self.index = parse_operand(operand_text)
+        self.idata = None
+        self.is_spectrum = False
+
+    def validate(self, validator):
+        idata = validator.variable(self.name, self.text)
+        if idata is not None and self.index is not None and idata.idata_type not in IDATA_SPECTRUM_DTYPES:
+            validator.error("Variable %s is indexed but is not a spectrum" % self.text)
+        return idata
+
+    def link(self, experiment):
+        self.idata = experiment.variables[self.name]
+
+        # risolvo una volta sola l'accesso allo slot, cosi' get/set non controllano piu' l'indice
+        values = experiment.store.values
+        slot = self.idata.idata_slot
+        index = self.index
+        self.is_spectrum = index is None and self.idata.idata_type in IDATA_SPECTRUM_DTYPES
+        if self.is_spectrum:
+            coerce = spectrum_coercer(self.idata.idata_type)
+
+            def get():
+                return values[slot]
+
+            def set(value):
+                values[slot] = coerce(value)
+        elif index is None:
+            def get():
+                return values[slot]
 
-        operation_nodes = xml_root.findall("operations")[0]
-        for operation_node in operation_nodes:
-            self.parse_operation(operation_node)
+            def set(value):
+                values[slot] = value
+        else:
+            def get():
+                return values[slot][index]
+
+            def set(value):
+                values[slot][index] = value
+        self.get = get
+        self.set = set
+
+
+def resolve_attr_name(experiment, attr_name_variable):
+    # la variabile contiene il nome dell'attributo tango, eventualmente con [index]
+    return parse_operand(experiment.variables[attr_name_variable].idata_value)
+
+
+def parse_operand(operand_text):
+    if "[" in operand_text:
+        operand_name = operand_text[:operand_text.index("[")]
+        operand_index = int(operand_text[operand_text.index("[") + 1:operand_text.index("]")])
+        return operand_name, operand_index
+    return operand_text, None
+
+
+def tokenize_expression(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = EXPRESSION_TOKEN.match(text, position)
+        if match is None:
+            raise Exception("Invalid expression %s: unexpected %r" % (text, text[position:].strip()[:10]))
+        number, name, symbol = match.groups()
+        if number is not None:
+            tokens.append(("const", float(number) if any(c in number for c in ".eE") else int(number)))
+        elif name is not None:
+            tokens.append(("name", name))
+        else:
+            tokens.append(("symbol", symbol))
+        position = match.end()
+    return tokens
+
+
+class ExpressionParser:
+
+    # l'albero sintattico e' fatto di tuple, cosi' l'operazione resta picklabile fino al link:
+    # ("const", value), ("var", name, index, text), ("unary", op, a), ("binary", op, a, b), ("call", name, args)
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize_expression(text)
+        self.position = 0
+
+    def parse(self):
+        tree = self.parse_binary(0)
+        if self.position != len(self.tokens):
+            raise Exception("Invalid expression %s: unexpected %s" % (self.text, self.tokens[self.position][1]))
+        return tree
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def take(self, value=None):
+        kind, token = self.peek()
+        if kind is None or (value is not None and token != value):
+            raise Exception("Invalid expression %s: expected %s" % (self.text, value or "an operand"))
+        self.position += 1
+        return kind, token
+
+    def binary_operator(self):
+        kind, token = self.peek()
+        if kind in ("symbol", "name") and token in EXPRESSION_BINARY_OPERATORS:
+            return token
+        return None
+
+    def parse_binary(self, min_precedence):
+        left = self.parse_unary()
+        while True:
+            operator_name = self.binary_operator()
+            if operator_name is None:
+                return left
+            precedence = EXPRESSION_BINARY_OPERATORS[operator_name][0]
+            if precedence < min_precedence:
+                return left
+            self.take()
+            # ** associa a destra, gli altri a sinistra
+            right = self.parse_binary(precedence if operator_name == "**" else precedence + 1)
+            left = ("binary", operator_name, left, right)
+
+    def parse_unary(self):
+        kind, token = self.peek()
+        if token == "not":
+            self.take()
+            return ("unary", "not", self.parse_binary(3))
+        if kind == "symbol" and token in ("-", "+"):
+            self.take()
+            # -x**2 e' -(x**2)
+            return ("unary", token, self.parse_binary(7))
+        return self.parse_primary()
+
+    def parse_primary(self):
+        kind, token = self.take()
+        if kind == "const":
+            return ("const", token)
+        if kind == "symbol":
+            if token != "(":
+                raise Exception("Invalid expression %s: unexpected %s" % (self.text, token))
+            tree = self.parse_binary(0)
+            self.take(")")
+            return tree
+        if self.peek()[1] == "(":
+            self.take("(")
+            args = []
+            if self.peek()[1] != ")":
+                args.append(self.parse_binary(0))
+                while self.peek()[1] == ",":
+                    self.take(",")
+                    args.append(self.parse_binary(0))
+            self.take(")")
+            if token not in EXPRESSION_FUNCTIONS:
+                raise Exception("Invalid expression %s: unknown function %s" % (self.text, token))
+            if len(args) not in EXPRESSION_FUNCTIONS[token]:
+                raise Exception("Invalid expression %s: %s takes %s arguments"
+                                % (self.text, token, " or ".join(str(count) for count in EXPRESSION_FUNCTIONS[token])))
+            return ("call", token, tuple(args))
+        if token in EXPRESSION_CONSTANTS:
+            return ("const", EXPRESSION_CONSTANTS[token])
+        if token in EXPRESSION_BINARY_OPERATORS or token in EXPRESSION_UNARY_OPERATORS:
+            raise Exception("Invalid expression %s: unexpected %s" % (self.text, token))
+        name, index = parse_operand(token)
+        return ("var", name, index, token)
+
+
+class Expression:
+
+    def __init__(self, text):
+        self.text = text
+        self.tree = ExpressionParser(text).parse()
+
+    def variables(self, tree=None):
+        tree = self.tree if tree is None else tree
+        if tree[0] == "var":
+            return [tree]
+        if tree[0] == "unary":
+            return self.variables(tree[2])
+        if tree[0] == "binary":
+            return self.variables(tree[2]) + self.variables(tree[3])
+        if tree[0] == "call":
+            return [var for arg in tree[2] for var in self.variables(arg)]
+        return []
+
+    def validate(self, validator):
+        for _, name, index, text in self.variables():
+            idata = validator.variable(name, text)
+            if idata is None:
+                continue
+            if index is not None and idata.idata_type not in IDATA_SPECTRUM_DTYPES:
+                validator.error("Variable %s is indexed but is not a spectrum" % text)
+            elif idata.idata_type in (IDATA_TYPE_STRING_SCALAR, IDATA_TYPE_STRING_SPECTRUM):
+                validator.error("Variable %s used in expression %s is not numeric" % (text, self.text))
+
+    def compile(self, experiment):
+        return compile_expression(self.tree, experiment.variables, experiment.store.values)
+
+    def compile_predicate(self, experiment):
+        # un risultato spectrum e' vero se lo e' per tutti gli elementi (per != basta un elemento diverso)
+        evaluate = self.compile(experiment)
+        reduce = numpy.any if self.tree[0] == "binary" and self.tree[1] in ("!=", "notequal") else numpy.all
+
+        def test():
+            value = evaluate()
+            if isinstance(value, numpy.ndarray):
+                return bool(reduce(value))
+            return bool(value)
+        return test
+
+
+def compile_expression(tree, variables, values):
+    # ogni nodo diventa una closure; variabili risolte allo slot, costanti ripiegate
+    kind = tree[0]
+    if kind == "const":
+        value = tree[1]
+        return lambda: value
+    if kind == "var":
+        slot = variables[tree[1]].idata_slot
+        index = tree[2]
+        if index is None:
+            return lambda: values[slot]
+        return lambda: values[slot][index]
+
+    if kind == "unary":
+        function = EXPRESSION_UNARY_OPERATORS[tree[1]]
+        args = (tree[2],)
+    elif kind == "binary":
+        function = EXPRESSION_BINARY_OPERATORS[tree[1]][1]
+        args = (tree[2], tree[3])
+    else:
+        args = tree[2]
+        function = EXPRESSION_FUNCTIONS[tree[1]][len(args)]
+    if all(arg[0] == "const" for arg in args):
+        value = function(*[arg[1] for arg in args])
+        return lambda: value
+
+    compiled = [compile_expression(arg, variables, values) for arg in args]
+    if len(compiled) == 1:
+        a, = compiled
+        return lambda: function(a())
+    if len(compiled) == 2:
+        a, b = compiled
+        if args[1][0] == "const":
+            b_value = args[1][1]
+            return lambda: function(a(), b_value)
+        if args[0][0] == "const":
+            a_value = args[0][1]
+            return lambda: function(a_value, b())
+        return lambda: function(a(), b())
+    return lambda: function(*[evaluate() for evaluate in compiled])
+
+
+class Operation:
+
+    tag = None
+    # set at link time from the logger level; when False trace records are never built
+    trace = False
+
+    def __init__(self, operation_node):
+        self.body = []
+
+    def validate(self, validator):
+        for operation in self.body:
+            operation.validate(validator)
+
+    def link(self, experiment):
+        for operation in self.body:
+            operation.link(experiment)
+
+    def execute(self):
+        raise NotImplementedError
+
+    def close(self):
+        for operation in self.body:
+            operation.close()
+
+    def written_variables(self):
+        written = set()
+        for operation in self.body:
+            written |= operation.written_variables()
+        return written
+
+    def read_variables(self):
+        # variabili lette durante l'esecuzione; quelle risolte al link (nomi degli attributi) non contano
+        read = set()
+        for operation in self.body:
+            read |= operation.read_variables()
+        return read
+
+    def estimate(self, estimator, repeat):
+        estimator.estimate_block(self.body, repeat)
+
+
+def operand_names(*operands):
+    # le costanti e gli operandi assenti non leggono variabili
+    return {operand.name for operand in operands if isinstance(operand, Operand)}
+
+
+def attr_name_operand(tango_attr_name):
+    # il nome dell'attributo e' letterale oppure preso da uno spectrum di stringhe (name[index])
+    if tango_attr_name.endswith("]"):
+        return Operand(tango_attr_name)
+    return Constant(tango_attr_name)
+
+
+def attr_value_operand(tango_attr_value):
+    # il valore e' un intero letterale, un elemento di uno spectrum o una variabile intera
+    if tango_attr_value.endswith("]"):
+        return Operand(tango_attr_value)
+    try:
+        return Constant(int(tango_attr_value))
+    except ValueError:
+        return Operand(tango_attr_value)
+
+
+def attr_value_getter(attr_value):
+    if isinstance(attr_value, Operand) and attr_value.index is None:
+        # variabili intere: gli spectrum vanno a write_attribute senza copie
+        return attr_value.get
+    value_getter = attr_value.get
+    return lambda: int(value_getter())
+
+
+class OpWriteAttribute(Operation):
+
+    tag = OP_TAG_WRITE_ATTRIBUTE
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.tango_device_name = operation_node.attrib["tango_device_name"]
+        self.device = None
+
+        self.attr_name = attr_name_operand(operation_node.attrib["tango_attr_name"])
+        self.attr_value = attr_value_operand(operation_node.attrib["tango_attr_value"])
+        # batch="false" tiene la scrittura fuori da write_attributes
+        self.batch = operation_node.attrib.get("batch") != "false"
+        self.value_getter = None
+        self.invalidate = None
+
+    def validate(self, validator):
+        validator.device(self.tango_device_name)
+        self.attr_name.validate(validator)
+        self.attr_value.validate(validator)
+
+    def link(self, experiment):
+        self.device = experiment.get_device(self.tango_device_name)
+        self.attr_name.link(experiment)
+        self.attr_value.link(experiment)
+        self.value_getter = attr_value_getter(self.attr_value)
+        self.invalidate = experiment.attribute_cache.invalidator(self.tango_device_name)
 
-    def parse_operation(self, operation_node):
-        if operation_node.tag == OP_TAG_WRITE_ATTRIBUTE:
-            self.op_write_attribute(operation_node)
-        elif operation_node.tag == OP_TAG_READ_ATTRIBUTE:
-            self.op_read_attribute(operation_node)
-        elif operation_node.tag == OP_TAG_SET_VARIABLE:
-            self.op_set_variable(operation_node)
-        elif operation_node.tag == OP_TAG_COMMAND_INOUT:
-            self.op_command_inout(operation_node)
-        elif operation_node.tag == OP_TAG_WHILE:
-            self.op_while(operation_node)
-        elif operation_node.tag == OP_TAG_CYCLE:
-            self.op_cycle(operation_node)
-        elif operation_node.tag == OP_TAG_IF:
-            self.op_if(operation_node)
-        elif operation_node.tag == OP_TAG_LOG:
-            self.op_log(operation_node)
+    def read_variables(self):
+        return operand_names(self.attr_name, self.attr_value)
+
+    def estimate(self, estimator, repeat):
+        estimator.add_call(self.tango_device_name, self.attr_name.get(), "write_attribute", repeat)
+
+    def execute(self):
+        attr_name = self.attr_name.get()
+        self.device.write_attribute(attr_name, self.value_getter())
+        if self.invalidate is not None:
+            self.invalidate(attr_name)
+        if self.trace:
+            logger.log(TRACE, "Executing op_write_attribute")
+
+
+class OpReadAttribute(Operation):
+
+    tag = OP_TAG_READ_ATTRIBUTE
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.tango_device_name = operation_node.attrib["tango_device_name"]
+        self.device = None
+        # nome della variabile che contiene il nome dell'attributo tango (stringa)
+        self.attr_name_variable = operation_node.attrib["tango_attr_name"]
+        self.attr_name = None
+        self.attr_index = None
+        # variabile a cui assegnare il valore tornato dalla read_attribute().value
+        self.target = Operand(operation_node.attrib["var_name"])
+        self.batch = operation_node.attrib.get("batch") != "false"
+        self.cached_read = None
+
+    def validate(self, validator):
+        validator.device(self.tango_device_name)
+        validator.attr_name_variable(self.attr_name_variable)
+        self.target.validate(validator)
+
+    def link(self, experiment):
+        self.device = experiment.get_device(self.tango_device_name)
+        self.attr_name, self.attr_index = resolve_attr_name(experiment, self.attr_name_variable)
+        self.target.link(experiment)
+        if experiment.attribute_cache.is_cached(self.tango_device_name, self.attr_name):
+            self.cached_read = experiment.attribute_cache.reader(self.tango_device_name, self.device, self.attr_name)
+
+    def written_variables(self):
+        return {self.target.name}
+
+    def estimate(self, estimator, repeat):
+        if self.cached_read is not None:
+            estimator.add_cached_read(self.tango_device_name, self.attr_name, repeat)
         else:
-            raise Exception("Operation tag not recognized: %s" % operation_node.tag)
+            estimator.add_call(self.tango_device_name, self.attr_name, "read_attribute", repeat)
 
-    def op_write_attribute(self, operation_node):
-        # recupero il nome del tango device dal xml
-        tango_device_name = operation_node.attrib["tango_device_name"]
-        # usa il nome recuperato per cercare in DeviceProxy nel dizionario devices di experiment
-        tango_device = None
-        if tango_device_name not in self.devices:
-            raise Exception("device_name %s not in devices dicionary" % tango_device_name)
+    def execute(self):
+        if self.cached_read is not None:
+            tango_attr_value = self.cached_read()
         else:
-            tango_device = self.devices[tango_device_name]
-
-        # recupero il nome della variabile che contiene il nome dell'attributo tango (stringa
-        tango_attr_name = operation_node.attrib["tango_attr_name"]
-        tango_attr_value = operation_node.attrib["tango_attr_value"]
-
-        if tango_attr_name.endswith("]"):
-            # recupero l'index
-            attr_index = int(tango_attr_name[tango_attr_name.index("[") + 1:tango_attr_name.index("]")])
-            # recupero in name
-            attr_name = tango_attr_name[:tango_attr_name.index("[")]
-            attr_to_write = self.variables[attr_name].idata_value[attr_index]
-
-            if tango_attr_value.endswith("]"):
-                value_index = int(tango_attr_value[tango_attr_value.index("[") + 1:tango_attr_value.index("]")])
-                value_name = tango_attr_value[:tango_attr_value.index("[")]
-                # usa il nome recuperato per cercare l'array in ...
-
-                value_to_write = self.variables[value_name].idata_value[value_index]
-                tango_device.write_attribute(attr_to_write, int(value_to_write))
+            tango_attr_value = self.device.read_attribute(self.attr_name).value
+        if self.attr_index is not None:
+            tango_attr_value = tango_attr_value[self.attr_index]
+        self.target.set(tango_attr_value)
+
+
+class OpReadAttributes(Operation):
+
+    tag = OP_TAG_READ_ATTRIBUTES
+
+    def __init__(self, reads):
+        Operation.__init__(self, None)
+        self.tango_device_name = reads[0].tango_device_name
+        self.device = None
+        self.reads = reads
+        self.attr_names = None
+        self.scatter = None
+
+    def validate(self, validator):
+        for read in self.reads:
+            read.validate(validator)
+
+    def link(self, experiment):
+        self.device = experiment.get_device(self.tango_device_name)
+        for read in self.reads:
+            read.link(experiment)
+        # gli attributi in cache non vanno nella read_attributes, li serve la cache
+        self.attr_names = [read.attr_name for read in self.reads if read.cached_read is None]
+        self.scatter = [(read.attr_index, read.target.set, read.cached_read) for read in self.reads]
+
+    def written_variables(self):
+        return {read.target.name for read in self.reads}
+
+    def estimate(self, estimator, repeat):
+        if self.attr_names:
+            estimator.add_call(self.tango_device_name, ",".join(self.attr_names), "read_attributes", repeat)
+        for read in self.reads:
+            if read.cached_read is not None:
+                estimator.add_cached_read(self.tango_device_name, read.attr_name, repeat)
+
+    def execute(self):
+        device_attributes = iter(self.device.read_attributes(self.attr_names) if self.attr_names else ())
+        for attr_index, set_target, cached_read in self.scatter:
+            if cached_read is not None:
+                tango_attr_value = cached_read()
             else:
-                tango_device.write_attribute(attr_to_write, int(tango_attr_value))
-        else:
-            if tango_attr_value.endswith("]"):
-                value_index = int(tango_attr_value[tango_attr_value.index("[") + 1:tango_attr_value.index("]")])
-                value_name = tango_attr_value[:tango_attr_value.index("[")]
-                # usa il nome recuperato per cercare l'array in ...
-
-                value_to_write = self.variables[value_name].idata_value[value_index]
-                tango_device.write_attribute(tango_attr_name, int(value_to_write))
+                tango_attr_value = next(device_attributes).value
+            if attr_index is not None:
+                tango_attr_value = tango_attr_value[attr_index]
+            set_target(tango_attr_value)
+
+
+class OpWriteAttributes(Operation):
+
+    tag = OP_TAG_WRITE_ATTRIBUTES
+
+    def __init__(self, writes):
+        Operation.__init__(self, None)
+        self.tango_device_name = writes[0].tango_device_name
+        self.device = None
+        self.writes = writes
+        self.getters = None
+        self.invalidate = None
+
+    def validate(self, validator):
+        for write in self.writes:
+            write.validate(validator)
+
+    def link(self, experiment):
+        self.device = experiment.get_device(self.tango_device_name)
+        for write in self.writes:
+            write.link(experiment)
+        self.getters = [(write.attr_name.get, write.value_getter) for write in self.writes]
+        self.invalidate = experiment.attribute_cache.invalidator(self.tango_device_name)
+
+    def read_variables(self):
+        read = set()
+        for write in self.writes:
+            read |= write.read_variables()
+        return read
+
+    def estimate(self, estimator, repeat):
+        estimator.add_call(self.tango_device_name, ",".join(attr_name() for attr_name, _ in self.getters),
+                           "write_attributes", repeat)
+
+    def execute(self):
+        name_values = [(attr_name(), attr_value()) for attr_name, attr_value in self.getters]
+        self.device.write_attributes(name_values)
+        if self.invalidate is not None:
+            for attr_name, _ in name_values:
+                self.invalidate(attr_name)
+        if self.trace:
+            logger.log(TRACE, "Executing op_write_attributes")
+
+
+def batch_operations(operations):
+    # raggruppa letture/scritture consecutive sullo stesso device in una sola chiamata;
+    # una seconda scrittura sullo stesso attributo (Trigger=1 poi Trigger=0) apre un nuovo gruppo
+    batched = []
+    run = []
+    run_attr_names = set()
+    for operation in operations + [None]:
+        if run and (operation is None or type(operation) is not type(run[0])
+                    or operation.tango_device_name != run[0].tango_device_name or not operation.batch
+                    or (isinstance(operation, OpWriteAttribute) and operation.attr_name.text in run_attr_names)):
+            if len(run) == 1:
+                batched.append(run[0])
+            elif isinstance(run[0], OpReadAttribute):
+                batched.append(OpReadAttributes(run))
             else:
-                tango_device.write_attribute(tango_attr_name, int(tango_attr_value))
-
-        print("Executing op_write_attribute")
-
-    def op_read_attribute(self, operation_node):
-        # recupero il nome del tango device dal xml
-        tango_device_name = operation_node.attrib["tango_device_name"]
-        # usa il nome recuperato per cercare in DeviceProxy nel dizionario devices di experiment
-        tango_device = self.devices[tango_device_name]
-
-        # recupero il nome della variabile che contiene il nome dell'attributo tango (stringa)
-        var_attr_name_variable = operation_node.attrib["tango_attr_name"]
-        # usa il nome recuperato per cercare in ...
-        tango_attr_name = self.variables[var_attr_name_variable].idata_value
-        if tango_attr_name.endswith("]"):
-            index = int(tango_attr_name[tango_attr_name.index("[") + 1:tango_attr_name.index("]")])
-
-            # recupero il nome della variabile a cui assegnare il valore tornato dalla read_attribute().value()
-            name_of_variable_to_write_to = operation_node.attrib["var_name"]
-
-            variable_to_write_to = self.variables[name_of_variable_to_write_to]
-            tango_attr_values = tango_device.read_attribute(tango_attr_name).value
-            variable_to_write_to.idata_value = tango_attr_values[index]
-        else:
-            # recupero il nome della variabile a cui assegnare il valore tornato dalla read_attribute().value()
-            name_of_variable_to_write_to = operation_node.attrib["var_name"]
-
-            variable_to_write_to = self.variables[name_of_variable_to_write_to]
-
-            variable_to_write_to.idata_value = tango_device.read_attribute(tango_attr_name).value
-
-    def op_command_inout(self, operation_node):
-
-        print("Executing op_command_inout")
-
-        # recupero il nome del tango device dal xml
-        tango_device_name = operation_node.attrib["tango_device_name"]
-        # usa il nome recuperato per cercare in DeviceProxy nel dizionario devices di experiment
-        tango_device = self.devices[tango_device_name]
-        command_input = None
-
-        # recupero il nome della variabile che contiene il nome dell'attributo tango (stringa)
-        var_attr_name_variable = operation_node.attrib["tango_attr_name"]
-
-        tango_device.command_inout(command_input)
-
-
-    def op_cycle(self, operation_node):
-        print("Executing op_cycle")
-
-        cycle_var_name = operation_node.attrib["var_name"]
-
-        if not operation_node.attrib["cycles"] in self.variables:
-            raise Exception("Constant %s not present in experiment dictionary" % operation_node.attrib["cycles"])
-
-        idata_cycles = self.variables[operation_node.attrib["cycles"]]
-        if idata_cycles.idata_type == IDATA_TYPE_INT_SCALAR:
-            cycle_cycles = idata_cycles.idata_value
+                batched.append(OpWriteAttributes(run))
+            run = []
+            run_attr_names = set()
+        if isinstance(operation, (OpReadAttribute, OpWriteAttribute)) and operation.batch:
+            run.append(operation)
+            if isinstance(operation, OpWriteAttribute):
+                run_attr_names.add(operation.attr_name.text)
+        elif operation is not None:
+            batched.append(operation)
+    return batched
+
+
+class OpCommandInout(Operation):
+
+    tag = OP_TAG_COMMAND_INOUT
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.tango_device_name = operation_node.attrib["tango_device_name"]
+        self.device = None
+        self.command_name = operation_node.attrib["tango_attr_name"]
+        # argomento preso da una variabile, passato col suo tipo; il valore di ritorno va in result
+        self.argin = Operand(operation_node.attrib["argin"]) if "argin" in operation_node.attrib else None
+        self.result = Operand(operation_node.attrib["result"]) if "result" in operation_node.attrib else None
+
+    def validate(self, validator):
+        validator.device(self.tango_device_name)
+        if self.argin is not None:
+            self.argin.validate(validator)
+        if self.result is not None:
+            self.result.validate(validator)
+
+    def link(self, experiment):
+        self.device = experiment.get_device(self.tango_device_name)
+        if self.argin is not None:
+            self.argin.link(experiment)
+        if self.result is not None:
+            self.result.link(experiment)
+
+    def written_variables(self):
+        return {self.result.name} if self.result is not None else set()
+
+    def read_variables(self):
+        return operand_names(self.argin)
+
+    def estimate(self, estimator, repeat):
+        estimator.add_call(self.tango_device_name, self.command_name, "command_inout", repeat)
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_command_inout")
+        if self.argin is not None:
+            command_output = self.device.command_inout(self.command_name, self.argin.get())
         else:
-            raise Exception("The type of the variable %s used in cycle is not int" % idata_cycles.idata_name)
-
-        idata_cycle_var = self.variables[cycle_var_name]
-        if not cycle_var_name in self.variables:
-            raise Exception("Variable %s not in experiment dictionary" % cycle_var_name)
-
-        cycle_step = operation_node.attrib["step"]
-        if not cycle_step in self.variables:
-            raise Exception("Constant %s not in experiment dictionary" % cycle_step)
-
-        idata_cycle_step = self.variables[cycle_step]
-
-        if (idata_cycle_var.idata_type == IDATA_TYPE_INT_SCALAR and idata_cycle_step.idata_type == IDATA_TYPE_INT_SPECTRUM)  \
-            or (idata_cycle_var.idata_type == IDATA_TYPE_FLOAT_SCALAR and idata_cycle_step.idata_type == IDATA_TYPE_FLOAT_SPECTRUM):
-            pass
+            command_output = self.device.command_inout(self.command_name)
+        if self.result is not None:
+            self.result.set(command_output)
+
+
+class GroupOperation(Operation):
+
+    # una chiamata a tutti i membri di un gruppo di device, in parallelo; i risultati e gli errori
+    # di ogni membro finiscono in due spectrum, nell'ordine dei membri
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.tango_group_name = operation_node.attrib["tango_group_name"]
+        self.results = Operand(operation_node.attrib["results"]) if "results" in operation_node.attrib else None
+        self.errors = Operand(operation_node.attrib["errors"]) if "errors" in operation_node.attrib else None
+        self.member_names = None
+        self.devices = None
+        self.missing_result = None
+        self.executor = None
+
+    def validate(self, validator):
+        validator.group(self.tango_group_name)
+        if self.results is not None:
+            idata = self.results.validate(validator)
+            if idata is not None and (self.results.index is not None or idata.idata_type not in IDATA_SPECTRUM_DTYPES):
+                validator.error("Variable %s collecting group results must be a spectrum" % self.results.text)
+        if self.errors is not None:
+            idata = self.errors.validate(validator)
+            if idata is not None and (self.errors.index is not None or idata.idata_type != IDATA_TYPE_STRING_SPECTRUM):
+                validator.error("Variable %s collecting group errors must be %s"
+                                % (self.errors.text, IDATA_TYPE_STRING_SPECTRUM))
+
+    def link(self, experiment):
+        self.member_names = experiment.groups[self.tango_group_name]
+        self.devices = [experiment.get_device(member_name) for member_name in self.member_names]
+        if self.results is not None:
+            self.results.link(experiment)
+            self.missing_result = GROUP_MISSING_RESULTS[self.results.idata.idata_type]
+        if self.errors is not None:
+            self.errors.link(experiment)
+
+    def written_variables(self):
+        return {operand.name for operand in (self.results, self.errors) if operand is not None}
+
+    def fan_out(self, member_call):
+        if len(self.devices) > 1 and self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.devices) - 1,
+                                               thread_name_prefix="group %s" % self.tango_group_name)
+        # come in parallel il primo membro e' servito dal thread chiamante
+        futures = [self.executor.submit(member_call, device) for device in self.devices[1:]]
+        first = Future()
+        try:
+            first.set_result(member_call(self.devices[0]))
+        except Exception as error:
+            first.set_exception(error)
+        wait(futures)
+        results = []
+        errors = []
+        for future in [first] + futures:
+            error = future.exception()
+            results.append(self.missing_result if error is not None else future.result())
+            errors.append("" if error is None else str(error))
+        return results, errors
+
+    def collect(self, results, errors, description):
+        if self.errors is not None:
+            self.errors.set(errors)
+        if self.results is not None:
+            # results e' uno spectrum con un elemento per membro: ogni membro deve restituire uno scalare
+            for member_name, result, error in zip(self.member_names, results, errors):
+                if not error and (result is None or numpy.ndim(result) > 0):
+                    raise Exception("%s on %s returned %s, results needs one scalar per member of group %s"
+                                    % (description, member_name, "no value" if result is None else "a spectrum",
+                                       self.tango_group_name))
+            self.results.set(results)
+        if self.errors is None and any(errors):
+            raise Exception("%s failed on group %s: %s" % (description, self.tango_group_name, "; ".join(
+                "%s: %s" % (member_name, error) for member_name, error in zip(self.member_names, errors) if error)))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        Operation.close(self)
+
+
+class OpGroupCommandInout(GroupOperation):
+
+    tag = OP_TAG_COMMAND_INOUT
+
+    def __init__(self, operation_node):
+        GroupOperation.__init__(self, operation_node)
+        self.command_name = operation_node.attrib["tango_attr_name"]
+        self.argin = Operand(operation_node.attrib["argin"]) if "argin" in operation_node.attrib else None
+
+    def validate(self, validator):
+        GroupOperation.validate(self, validator)
+        if self.argin is not None:
+            self.argin.validate(validator)
+
+    def link(self, experiment):
+        GroupOperation.link(self, experiment)
+        if self.argin is not None:
+            self.argin.link(experiment)
+
+    def read_variables(self):
+        return operand_names(self.argin)
+
+    def estimate(self, estimator, repeat):
+        estimator.add_fan_out(self.tango_group_name, self.member_names, self.command_name, "command_inout", repeat)
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_command_inout on group %s", self.tango_group_name)
+        command_name = self.command_name
+        if self.argin is not None:
+            argin = self.argin.get()
+            results, errors = self.fan_out(lambda device: device.command_inout(command_name, argin))
         else:
-            print("%s %s" % (idata_cycle_var.idata_type == IDATA_TYPE_FLOAT_SCALAR, idata_cycle_step.idata_type == IDATA_TYPE_FLOAT_SPECTRUM))
-            raise Exception("The variable incremented in the cycle %s and the increment %s must be same numerical type"\
-                             % (idata_cycle_var.idata_name, idata_cycle_step.idata_name))
-
-        for cnt in range(cycle_cycles):
-            for cycle_node in operation_node:
-                self.parse_operation(cycle_node)
-            self.variables[cycle_var_name].idata_value += self.variables[cycle_step].idata_value
-
-    def op_while(self, operation_node):
-        print("Executing op_while")
-        var1_name = operation_node.attrib["var1"]
-        var2_name = operation_node.attrib["var2"]
-        operator_name = operation_node.attrib["operator"]
-        var1_idata_value = None
-        var2_idata_value = None
-
-        if operator_name not in OPERATORS:
-            raise Exception("Invalid assignment for operator_name. Allowed names are: %s" % OPERATORS)
-
-        if "[" in var1_name:
-            var1_array_name = var1_name[:var1_name.index("[")]
-            index_var1 = int(var1_name[var1_name.index("[")+1:var1_name.index("]")])
-            if var1_array_name not in self.variables:
-                raise Exception("Variable %s not in Experiment dictionary" % var1_name)
-            var1_idata_value = self.variables[var1_array_name].idata_value[index_var1]
+            results, errors = self.fan_out(lambda device: device.command_inout(command_name))
+        self.collect(results, errors, "command_inout %s" % command_name)
+
+
+class OpGroupWriteAttribute(GroupOperation):
+
+    tag = OP_TAG_WRITE_ATTRIBUTE
+
+    def __init__(self, operation_node):
+        GroupOperation.__init__(self, operation_node)
+        self.attr_name = attr_name_operand(operation_node.attrib["tango_attr_name"])
+        self.attr_value = attr_value_operand(operation_node.attrib["tango_attr_value"])
+        self.value_getter = None
+        self.invalidators = None
+
+    def validate(self, validator):
+        GroupOperation.validate(self, validator)
+        if self.results is not None:
+            validator.error("write_attribute on group %s returns no results, only errors can be collected"
+                            % self.tango_group_name)
+        self.attr_name.validate(validator)
+        self.attr_value.validate(validator)
+
+    def link(self, experiment):
+        GroupOperation.link(self, experiment)
+        self.attr_name.link(experiment)
+        self.attr_value.link(experiment)
+        self.value_getter = attr_value_getter(self.attr_value)
+        invalidators = [experiment.attribute_cache.invalidator(member_name) for member_name in self.member_names]
+        self.invalidators = [invalidate for invalidate in invalidators if invalidate is not None]
+
+    def read_variables(self):
+        return operand_names(self.attr_name, self.attr_value)
+
+    def estimate(self, estimator, repeat):
+        estimator.add_fan_out(self.tango_group_name, self.member_names, self.attr_name.get(), "write_attribute", repeat)
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_write_attribute on group %s", self.tango_group_name)
+        attr_name = self.attr_name.get()
+        attr_value = self.value_getter()
+        results, errors = self.fan_out(lambda device: device.write_attribute(attr_name, attr_value))
+        for invalidate in self.invalidators:
+            invalidate(attr_name)
+        self.collect(results, errors, "write_attribute %s" % attr_name)
+
+
+class OpSetVariable(Operation):
+
+    tag = OP_TAG_SET_VARIABLE
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.target = Operand(operation_node.attrib["var_name"])
+        self.expression = Expression(operation_node.attrib["expression"])
+        self.evaluate = None
+        self.convert = None
+        self.spectrum_slot = None
+        self.values = None
+
+    def validate(self, validator):
+        idata = self.target.validate(validator)
+        if idata is not None and idata.idata_type in (IDATA_TYPE_STRING_SCALAR, IDATA_TYPE_STRING_SPECTRUM):
+            validator.error("Variable %s assigned by set_variable is not numeric" % self.target.text)
+        self.expression.validate(validator)
+
+    def link(self, experiment):
+        self.target.link(experiment)
+        self.evaluate = self.expression.compile(experiment)
+        idata_type = self.target.idata.idata_type
+        if self.target.is_spectrum:
+            self.convert = None
+            self.values = experiment.store.values
+            self.spectrum_slot = self.target.idata.idata_slot
+        elif self.target.index is not None:
+            self.convert = IDATA_SPECTRUM_CONVERTERS.get(idata_type)
         else:
-            var1_array_name = var1_name
-            if var1_array_name not in self.variables:
-                raise Exception("Variable %s not in Experiment dictionary" % var1_name)
-            var1_idata_value = self.variables[var1_array_name].idata_value
-
-        if "[" in var2_name:
-            var2_array_name = var2_name[:var2_name.index("[")]
-            index_var2 = int(var2_name[var2_name.index("[")+1:var2_name.index("]")])
-            if var2_array_name not in self.variables:
-                raise Exception("Variable %s not in Experiment dictionary" % var2_name)
-            var2_idata_value = self.variables[var2_array_name].idata_value[index_var2]
+            self.convert = IDATA_SCALAR_CONVERTERS.get(idata_type)
+
+    def written_variables(self):
+        return {self.target.name}
+
+    def read_variables(self):
+        return {name for _, name, _, _ in self.expression.variables()}
+
+    def estimate(self, estimator, repeat):
+        # nessun device coinvolto: si esegue davvero, cosi' i cicli successivi vedono i valori calcolati
+        if estimator.replay_variables:
+            self.execute()
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_set_variable %s = %s", self.target.text, self.expression.text)
+        value = self.evaluate()
+        if self.spectrum_slot is not None:
+            if numpy.ndim(value) == 0:
+                # uno scalare va in ogni elemento dello spectrum, che mantiene lunghezza e tipo
+                self.values[self.spectrum_slot][...] = value
+                return
+            if self.expression.tree[0] == "var":
+                # x = y: una copia, altrimenti le due variabili condividerebbero lo stesso array
+                value = numpy.array(value)
+        elif self.convert is not None:
+            if numpy.ndim(value) > 0:
+                raise Exception("Expression %s gives a spectrum but %s is a scalar"
+                                % (self.expression.text, self.target.text))
+            value = self.convert(value)
+        self.target.set(value)
+
+
+# (cycle variable, step) type pairs; spectrum variables are stepped element-wise in place
+CYCLE_STEP_TYPES = frozenset([
+    (IDATA_TYPE_INT_SCALAR, IDATA_TYPE_INT_SPECTRUM),
+    (IDATA_TYPE_FLOAT_SCALAR, IDATA_TYPE_FLOAT_SPECTRUM),
+    (IDATA_TYPE_INT_SPECTRUM, IDATA_TYPE_INT_SPECTRUM),
+    (IDATA_TYPE_FLOAT_SPECTRUM, IDATA_TYPE_FLOAT_SPECTRUM),
+])
+
+
+def axis_trajectory(start, step, count):
+    # posizioni di un asse: start, poi un incremento per iterazione (lo step spectrum viene ripetuto);
+    # l'ultima posizione e' il valore della variabile a fine ciclo
+    step = numpy.asarray(step)
+    # come range(), un numero di cicli negativo non fa nessuna iterazione
+    count = max(count, 0)
+    if numpy.ndim(start) == 0:
+        increments = numpy.resize(step, count)
+        return start + numpy.concatenate((numpy.zeros(1, dtype=increments.dtype), numpy.cumsum(increments)))
+    # variabile spectrum: ad ogni iterazione si somma tutto lo step, elemento per elemento
+    return start + numpy.arange(count + 1)[:, numpy.newaxis] * step
+
+
+def mesh_trajectory(axis_positions, snake=False):
+    # griglia con il primo asse piu' esterno; con snake ogni asse interno inverte il verso a righe alterne
+    counts = [len(positions) for positions in axis_positions]
+    grid = numpy.indices(counts).reshape(len(counts), -1)
+    indices = grid.copy()
+    if snake:
+        for axis in range(1, len(counts)):
+            row = numpy.ravel_multi_index(tuple(grid[:axis]), counts[:axis])
+            odd = row % 2 == 1
+            indices[axis][odd] = counts[axis] - 1 - grid[axis][odd]
+    return [positions[axis_indices] for positions, axis_indices in zip(axis_positions, indices)]
+
+
+class ScanAxis:
+
+    def __init__(self, axis_node):
+        self.var_name = axis_node.attrib["var_name"]
+        self.cycles_name = axis_node.attrib["cycles"]
+        self.step_name = axis_node.attrib["step"]
+        # variabile spectrum opzionale che riceve la traiettoria calcolata
+        self.trajectory_name = axis_node.attrib.get("trajectory")
+        self.cycles_slot = None
+        self.var_slot = None
+        self.step_slot = None
+        self.trajectory_slot = None
+        self.is_scalar = True
+
+    def validate(self, validator, scalar_only=False, written=()):
+        # written: variabili scritte dal corpo; la traiettoria le sovrascriverebbe a ogni iterazione
+        if self.var_name in written:
+            validator.error("The variable %s follows the scan trajectory and cannot be written inside the loop"
+                            % self.var_name)
+        if not self.cycles_name in validator.variables:
+            validator.error("Constant %s not present in experiment dictionary" % self.cycles_name)
+        elif not validator.variables[self.cycles_name].idata_type == IDATA_TYPE_INT_SCALAR:
+            validator.error("The type of the variable %s used in cycle is not int" % self.cycles_name)
+
+        if not self.var_name in validator.variables:
+            validator.error("Variable %s not in experiment dictionary" % self.var_name)
+        if not self.step_name in validator.variables:
+            validator.error("Constant %s not in experiment dictionary" % self.step_name)
+        if self.var_name in validator.variables and self.step_name in validator.variables:
+            var_type = validator.variables[self.var_name].idata_type
+            if (var_type, validator.variables[self.step_name].idata_type) not in CYCLE_STEP_TYPES:
+                validator.error("The variable incremented in the cycle %s and the increment %s must be same numerical type"
+                                % (self.var_name, self.step_name))
+            elif (scalar_only or self.trajectory_name is not None) and var_type in IDATA_SPECTRUM_DTYPES:
+                validator.error("The variable %s of a scan trajectory must be scalar" % self.var_name)
+            elif self.trajectory_name is not None:
+                idata_trajectory = validator.variable(self.trajectory_name)
+                if idata_trajectory is not None and idata_trajectory.idata_type != validator.variables[self.step_name].idata_type:
+                    validator.error("The trajectory %s must have the same type as the step %s"
+                                    % (self.trajectory_name, self.step_name))
+
+    def link(self, experiment):
+        self.cycles_slot = experiment.variables[self.cycles_name].idata_slot
+        self.var_slot = experiment.variables[self.var_name].idata_slot
+        self.step_slot = experiment.variables[self.step_name].idata_slot
+        self.is_scalar = experiment.variables[self.var_name].idata_type not in IDATA_SPECTRUM_DTYPES
+        if self.trajectory_name is not None:
+            self.trajectory_slot = experiment.variables[self.trajectory_name].idata_slot
+
+    def read_variables(self):
+        return {self.var_name, self.cycles_name, self.step_name}
+
+    def positions(self, values):
+        return axis_trajectory(values[self.var_slot], values[self.step_slot], values[self.cycles_slot])
+
+
+class OpCycle(Operation):
+
+    tag = OP_TAG_CYCLE
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.var_name = operation_node.attrib["var_name"]
+        self.axis = ScanAxis(operation_node)
+        self.scan = operation_node.attrib.get("scan") == "true"
+        self.body = compile_block(operation_node)
+        self.values = None
+
+    def validate(self, validator):
+        # in modalita' scan la variabile segue la traiettoria; altrimenti il corpo la puo' modificare
+        scan = self.scan or self.axis.trajectory_name is not None
+        self.axis.validate(validator, written=Operation.written_variables(self) if scan else ())
+        Operation.validate(self, validator)
+
+    def link(self, experiment):
+        self.values = experiment.store.values
+        self.axis.link(experiment)
+        self.scan = self.scan or self.axis.trajectory_slot is not None
+        Operation.link(self, experiment)
+
+    def written_variables(self):
+        written = {self.var_name} | Operation.written_variables(self)
+        if self.axis.trajectory_name is not None:
+            written.add(self.axis.trajectory_name)
+        return written
+
+    def read_variables(self):
+        return self.axis.read_variables() | Operation.read_variables(self)
+
+    def estimate(self, estimator, repeat):
+        estimator.estimate_loop(self.body, repeat, self.values[self.axis.cycles_slot])
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_cycle")
+        if self.scan:
+            self.execute_scan()
+            return
+        body = self.body
+        values = self.values
+        var_slot = self.axis.var_slot
+        step_slot = self.axis.step_slot
+        if self.axis.is_scalar:
+            # variabile scalare: un elemento dello step per iterazione, lo step spectrum si ripete
+            steps = numpy.ravel(values[step_slot]).tolist() or [0]
+            count = len(steps)
+            for cnt in range(values[self.axis.cycles_slot]):
+                for operation in body:
+                    operation.execute()
+                values[var_slot] += steps[cnt % count]
+            return
+        for cnt in range(values[self.axis.cycles_slot]):
+            for operation in body:
+                operation.execute()
+            values[var_slot] += values[step_slot]
+
+    def execute_scan(self):
+        # la traiettoria si calcola una volta, le iterazioni la leggono per indice
+        body = self.body
+        values = self.values
+        var_slot = self.axis.var_slot
+        positions = self.axis.positions(values)
+        if self.axis.trajectory_slot is not None:
+            values[self.axis.trajectory_slot] = positions[:-1]
+        if self.axis.is_scalar:
+            points = positions.tolist()
         else:
-            var2_array_name = var2_name
-            if var2_array_name not in self.variables:
-                raise Exception("Variable %s not in Experiment dictionary" % var2_name)
-            var2_idata_value = self.variables[var2_array_name].idata_value
-
-        if operator_name == "greater":
-            while var1_idata_value > var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-        elif operator_name == "lesser":
-                while var1_idata_value < var2_idata_value:
-                    print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                    for op in operation_node:
-                        self.parse_operation(op)
-        elif operator_name == "equal":
-            while var1_idata_value == var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-        elif operator_name == "greaterequal":
-            while var1_idata_value >= var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-        elif operator_name == "lesserequal":
-            while var1_idata_value <= var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-        elif operator_name == "notequal":
-            while not var1_idata_value == var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-
-    def op_if(self, operation_node):
-        print("Executing op_if")
-        var1_name = operation_node.attrib["var1"]
-        var2_name = operation_node.attrib["var2"]
-        operator_name = operation_node.attrib["operator"]
-        var1_idata_value = None
-        var2_idata_value = None
-
-        if operator_name not in OPERATORS:
+            points = list(positions)
+        final = points.pop()
+        for point in points:
+            values[var_slot] = point.copy() if not self.axis.is_scalar else point
+            for operation in body:
+                operation.execute()
+        values[var_slot] = final
+
+
+class OpMesh(Operation):
+
+    tag = OP_TAG_MESH
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.axes = [ScanAxis(axis_node) for axis_node in operation_node.findall("axis")]
+        if not self.axes:
+            raise Exception("mesh needs at least one axis")
+        self.snake = operation_node.attrib.get("snake") == "true"
+        self.body = compile_block([node for node in operation_node if node.tag != "axis"])
+        self.values = None
+
+    def validate(self, validator):
+        written = Operation.written_variables(self)
+        for axis in self.axes:
+            axis.validate(validator, scalar_only=True, written=written)
+        Operation.validate(self, validator)
+
+    def link(self, experiment):
+        self.values = experiment.store.values
+        for axis in self.axes:
+            axis.link(experiment)
+        Operation.link(self, experiment)
+
+    def written_variables(self):
+        written = Operation.written_variables(self)
+        for axis in self.axes:
+            written.add(axis.var_name)
+            if axis.trajectory_name is not None:
+                written.add(axis.trajectory_name)
+        return written
+
+    def read_variables(self):
+        read = Operation.read_variables(self)
+        for axis in self.axes:
+            read |= axis.read_variables()
+        return read
+
+    def estimate(self, estimator, repeat):
+        points = 1
+        for axis in self.axes:
+            points *= max(self.values[axis.cycles_slot], 0)
+        estimator.estimate_loop(self.body, repeat, points)
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_mesh")
+        body = self.body
+        values = self.values
+        axis_points = mesh_trajectory([axis.positions(values)[:-1] for axis in self.axes], self.snake)
+        for axis, points in zip(self.axes, axis_points):
+            if axis.trajectory_slot is not None:
+                values[axis.trajectory_slot] = points
+        # a fine mesh ogni variabile resta sull'ultimo punto visitato
+        var_slots = [axis.var_slot for axis in self.axes]
+        for point in zip(*[points.tolist() for points in axis_points]):
+            for var_slot, position in zip(var_slots, point):
+                values[var_slot] = position
+            for operation in body:
+                operation.execute()
+
+
+class OpCondition(Operation):
+
+    # if/while accept condition="<expression>" in place of var1/operator/var2
+    expressions = True
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.test = None
+        self.body = compile_block(operation_node)
+        if self.expressions and "condition" in operation_node.attrib:
+            self.expression = Expression(operation_node.attrib["condition"])
+            self.message = "la condizione %s è verificata" % self.expression.text
+            return
+        self.expression = None
+        self.operator_name = operation_node.attrib["operator"]
+        if self.operator_name not in OPERATORS:
             raise Exception("Invalid assignment for operator_name. Allowed names are: %s" % OPERATORS)
+        self.compare = OPERATOR_FUNCTIONS[self.operator_name]
+        self.var1 = Operand(operation_node.attrib["var1"])
+        self.var2 = Operand(operation_node.attrib["var2"])
+        self.message = "la condizione %s %s %s è verificata" % (self.var1.text, self.operator_name, self.var2.text)
+
+    def validate(self, validator):
+        if self.expression is not None:
+            self.expression.validate(validator)
+        else:
+            self.var1.validate(validator)
+            self.var2.validate(validator)
+        Operation.validate(self, validator)
 
-        if "[" in var1_name:
-            var1_array_name = var1_name[:var1_name.index("[")]
-            index_var1 = int(var1_name[var1_name.index("[")+1:var1_name.index("]")])
-            if var1_array_name not in self.variables:
-                raise Exception("Variable %s not in Experiment dictionary" % var1_name)
-            var1_idata_value = self.variables[var1_array_name].idata_value[index_var1]
+    def link(self, experiment):
+        if self.expression is not None:
+            self.test = self.expression.compile_predicate(experiment)
         else:
-            var1_array_name = var1_name
-            if var1_array_name not in self.variables:
-                raise Exception("Variable %s not in Experiment dictionary" % var1_name)
-            var1_idata_value = self.variables[var1_array_name].idata_value
-
-        if "[" in var2_name:
-            var2_array_name = var2_name[:var2_name.index("[")]
-            index_var2 = int(var2_name[var2_name.index("[")+1:var2_name.index("]")])
-            if var2_array_name not in self.variables:
-                raise Exception("Variable %s not in Experiment dictionary" % var2_name)
-            var2_idata_value = self.variables[var2_array_name].idata_value[index_var2]
+            self.var1.link(experiment)
+            self.var2.link(experiment)
+            if self.var1.is_spectrum or self.var2.is_spectrum:
+                self.compare = spectrum_comparator(self.operator_name)
+            compare = self.compare
+            var1 = self.var1.get
+            var2 = self.var2.get
+            self.test = lambda: compare(var1(), var2())
+        Operation.link(self, experiment)
+
+    def condition_variables(self):
+        if self.expression is not None:
+            return {name for _, name, _, _ in self.expression.variables()}
+        return {self.var1.name, self.var2.name}
+
+    def read_variables(self):
+        return self.condition_variables() | Operation.read_variables(self)
+
+
+class OpWhile(OpCondition):
+
+    tag = OP_TAG_WHILE
+
+    def estimate(self, estimator, repeat):
+        # le set_variable del corpo le fa avanzare la simulazione: i loro bersagli non contano come dinamici,
+        # a meno che nel corpo non li scriva anche altro
+        simulated = [operation for operation in self.body if isinstance(operation, OpSetVariable)]
+        others = set()
+        for operation in self.body:
+            if not isinstance(operation, OpSetVariable):
+                others |= operation.written_variables()
+        inputs = set(self.condition_variables())
+        targets = set()
+        for operation in simulated:
+            inputs |= {name for _, name, _, _ in operation.expression.variables()}
+            targets |= operation.written_variables()
+        if not estimator.is_static(inputs - (targets - others)):
+            estimator.assume("%s: while on values changing at run time, assumed %d iterations"
+                             % (estimator.node, estimator.while_iterations))
+            estimator.estimate_loop(self.body, repeat, estimator.while_iterations)
+            return
+        # simulazione limitata: si ripetono solo le set_variable del corpo finche' la condizione regge
+        iterations = 0
+        while self.test() and iterations < estimator.while_limit:
+            for operation in simulated:
+                operation.execute()
+            iterations += 1
+        if iterations == estimator.while_limit:
+            estimator.assume("%s: while still true after %d simulated iterations" % (estimator.node, iterations))
+        # le set_variable sono gia' state eseguite dalla simulazione: il corpo si stima senza ripeterle
+        estimator.estimate_loop(self.body, repeat, iterations, replay_variables=False)
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_while")
+        body = self.body
+        test = self.test
+        while test():
+            if self.trace:
+                logger.log(TRACE, self.message)
+            for operation in body:
+                operation.execute()
+
+
+class OpIf(OpCondition):
+
+    tag = OP_TAG_IF
+
+    def estimate(self, estimator, repeat):
+        if estimator.is_static(self.condition_variables()):
+            if self.test():
+                estimator.estimate_block(self.body, repeat)
+            return
+        estimator.assume("%s: if on values changing at run time, assumed taken" % estimator.node)
+        estimator.estimate_block(self.body, repeat)
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_if")
+        if self.test():
+            if self.trace:
+                logger.log(TRACE, self.message)
+            for operation in self.body:
+                operation.execute()
+
+
+class OpWaitUntil(OpCondition):
+
+    tag = OP_TAG_WAIT_UNTIL
+    expressions = False
+
+    def __init__(self, operation_node):
+        # wait_until non ha corpo: eventuali figli non verrebbero mai eseguiti
+        if len(operation_node):
+            raise Exception("wait_until does not take child operations, found <%s>" % operation_node[0].tag)
+        OpCondition.__init__(self, operation_node)
+        self.tango_device_name = operation_node.attrib["tango_device_name"]
+        self.device = None
+        self.attr_name_variable = operation_node.attrib["tango_attr_name"]
+        self.attr_name = None
+        self.attr_index = None
+        self.timeout = float(operation_node.attrib["timeout"]) if "timeout" in operation_node.attrib else None
+        self.poll_min_period = float(operation_node.attrib.get("poll_min_period", WAIT_POLL_MIN_PERIOD))
+        self.poll_max_period = float(operation_node.attrib.get("poll_max_period", WAIT_POLL_MAX_PERIOD))
+        self.event_id = None
+        self.event_value = None
+        self.event_error = None
+        self.changed = None
+
+    def validate(self, validator):
+        OpCondition.validate(self, validator)
+        validator.device(self.tango_device_name)
+        validator.attr_name_variable(self.attr_name_variable)
+
+    def link(self, experiment):
+        OpCondition.link(self, experiment)
+        self.device = experiment.get_device(self.tango_device_name)
+        self.attr_name, self.attr_index = resolve_attr_name(experiment, self.attr_name_variable)
+        self.changed = threading.Event()
+
+    def written_variables(self):
+        return {self.var1.name}
+
+    def condition_variables(self):
+        return {self.var2.name}
+
+    def estimate(self, estimator, repeat):
+        estimator.add_call(self.tango_device_name, self.attr_name, "read_attribute", repeat)
+        estimator.add_wait(repeat, self.timeout)
+
+    def subscribe(self):
+        # la sottoscrizione resta attiva fino a close(), cosi' un wait_until in un ciclo non la rifa ogni volta
+        if self.event_id is None:
+            try:
+                self.event_id = self.device.subscribe_event(self.attr_name, EventType.CHANGE_EVENT, self.push_event)
+            except Exception:
+                # eventi non configurati sull'attributo: si passa al polling
+                self.event_id = False
+        return self.event_id is not False
+
+    def push_event(self, event):
+        if event.err:
+            self.event_error = event.errors
         else:
-            var2_array_name = var2_name
-            if var2_array_name not in self.variables:
-                raise Exception("Variable %s not in Experiment dictionary" % var2_name)
-            var2_idata_value = self.variables[var2_array_name].idata_value
-
-        if operator_name == "greater":
-            if var1_idata_value > var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-        elif operator_name == "lesser":
-                if var1_idata_value < var2_idata_value:
-                    print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                    for op in operation_node:
-                        self.parse_operation(op)
-        elif operator_name == "equal":
-            if var1_idata_value == var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-        elif operator_name == "greaterequal":
-            if var1_idata_value >= var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-        elif operator_name == "lesserequal":
-            if var1_idata_value <= var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-        elif operator_name == "notequal":
-            if not var1_idata_value == var2_idata_value:
-                print("la condizione %s %s %s è verificata" % (var1_name, operator_name, var2_name))
-                for op in operation_node:
-                    self.parse_operation(op)
-
-    def op_log(self, operation_node):
-
-        print("Executing op_log")
-
-        parameter_nodes = operation_node.findall("parameter")
-        message = operation_node.attrib["message"]
-        parameters = []
+            self.event_value = event.attr_value.value
+            self.event_error = None
+        self.changed.set()
+
+    def condition(self, tango_attr_value):
+        if self.attr_index is not None and tango_attr_value is not None:
+            tango_attr_value = tango_attr_value[self.attr_index]
+        self.var1.set(tango_attr_value)
+        return self.compare(self.var1.get(), self.var2.get())
+
+    def remaining(self, deadline):
+        if deadline is None:
+            return None
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Exception("wait_until %s %s %s timed out after %s s"
+                            % (self.var1.text, self.operator_name, self.var2.text, self.timeout))
+        return remaining
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_wait_until")
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        if self.subscribe():
+            self.wait_events(deadline)
+        else:
+            self.wait_polling(deadline)
+
+    def wait_events(self, deadline):
+        # ci si sveglia solo quando arriva un evento, cioe' quando la condizione puo' essere cambiata
+        if self.event_value is None:
+            self.event_value = self.device.read_attribute(self.attr_name).value
+        while True:
+            self.changed.clear()
+            if self.event_error is not None:
+                raise Exception("Error event on %s/%s: %s" % (self.tango_device_name, self.attr_name, self.event_error))
+            if self.condition(self.event_value):
+                return
+            self.changed.wait(self.remaining(deadline))
+
+    def wait_polling(self, deadline):
+        # periodo adattivo: raddoppia finche' il valore non cambia, torna al minimo quando cambia
+        period = self.poll_min_period
+        last_value = None
+        while True:
+            tango_attr_value = self.device.read_attribute(self.attr_name).value
+            if self.condition(tango_attr_value):
+                return
+            if last_value is not None and numpy.array_equal(tango_attr_value, last_value):
+                period = min(period * 2, self.poll_max_period)
+            else:
+                period = self.poll_min_period
+            last_value = tango_attr_value
+            remaining = self.remaining(deadline)
+            time.sleep(period if remaining is None else min(period, remaining))
 
-        for parameter_node in parameter_nodes:
+    def close(self):
+        if self.event_id:
+            self.device.unsubscribe_event(self.event_id)
+        self.event_id = None
+        self.event_value = None
+        OpCondition.close(self)
 
-            var_name = parameter_node.attrib["var"]
-            var_idata_value = None
 
-            print("var_name %s" % var_name)
+class OpLog(Operation):
 
-            if "[" in var_name:
-                var_array_name = var_name[:var_name.index("[")]
-                index_var = int(var_name[var_name.index("[") + 1:var_name.index("]")])
+    tag = OP_TAG_LOG
 
-                if var_array_name not in self.variables:
-                    raise Exception("Variable %s not in Experiment dictionary" % var_name)
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.message = operation_node.attrib["message"]
+        self.template = MessageTemplate(self.message)
+        self.parameters = [Operand(parameter_node.attrib["var"]) for parameter_node in operation_node.findall("parameter")]
+        self.enabled = True
 
-                var_idata_value = self.variables[var_array_name].idata_value[index_var]
-            else:
-                if var_array_name not in self.variables:
-                    raise Exception("Variable %s not in Experiment dictionary" % var_name)
+    def validate(self, validator):
+        for parameter in self.parameters:
+            parameter.validate(validator)
 
-                var_idata_value = self.variables[var_name].idata_value
+    def link(self, experiment):
+        for parameter in self.parameters:
+            parameter.link(experiment)
+        self.enabled = logger.isEnabledFor(logging.INFO)
 
-            print("idata_value %s" % var_idata_value)
+    def read_variables(self):
+        return operand_names(*self.parameters)
 
+    def execute(self):
+        if not self.enabled:
+            return
+        parameters = []
+        for parameter in self.parameters:
+            var_idata_value = parameter.get()
+            # gli spectrum possono cambiare prima che il sink scriva il messaggio
+            if isinstance(var_idata_value, numpy.ndarray):
+                var_idata_value = var_idata_value.copy()
             parameters.append(var_idata_value)
-            f_message = message.format(*parameters)
-            print(f_message)
+        logger.info(LogMessage(self.template, parameters),
+                    extra={"template": self.message, "parameters": parameters})
+
+
+# record column dtypes; strings cannot be recorded
+RECORD_DTYPES = {
+    IDATA_TYPE_INT_SCALAR: numpy.int64,
+    IDATA_TYPE_FLOAT_SCALAR: numpy.float64,
+    IDATA_TYPE_BOOLEAN_SCALAR: numpy.bool_,
+    IDATA_TYPE_STATE: numpy.int32,
+    IDATA_TYPE_INT_SPECTRUM: numpy.int64,
+    IDATA_TYPE_FLOAT_SPECTRUM: numpy.float64,
+    IDATA_TYPE_BOOLEAN_SPECTRUM: numpy.bool_,
+}
+
+
+def record_type(parameter, idata):
+    # un elemento di uno spectrum si registra come lo scalare corrispondente
+    if parameter.index is not None and idata.idata_type in IDATA_SPECTRUM_DTYPES:
+        return idata.idata_type.replace("spectrum", "scalar")
+    return idata.idata_type
+
+
+class OpRecord(Operation):
+
+    tag = OP_TAG_RECORD
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        self.path = operation_node.attrib["path"]
+        self.record_format = operation_node.attrib.get("format")
+        self.chunk_size = int(operation_node.attrib.get("chunk_size", RECORD_CHUNK_SIZE))
+        self.chunk_bytes = int(operation_node.attrib.get("chunk_bytes", RECORD_CHUNK_BYTES))
+        self.parameters = [Operand(parameter_node.attrib["var"]) for parameter_node in operation_node.findall("parameter")]
+        self.getters = None
+        self.recorder = None
+
+    def validate(self, validator):
+        for parameter in self.parameters:
+            idata = parameter.validate(validator)
+            if idata is not None and record_type(parameter, idata) not in RECORD_DTYPES:
+                validator.error("Variable %s of type %s cannot be recorded" % (parameter.text, idata.idata_type))
+        if self.path in validator.record_paths:
+            validator.error("Record path %s used by more than one record operation" % self.path)
+        validator.record_paths.add(self.path)
+
+    def link(self, experiment):
+        dtypes = []
+        for parameter in self.parameters:
+            parameter.link(experiment)
+            dtypes.append(RECORD_DTYPES[record_type(parameter, parameter.idata)])
+        self.getters = [parameter.get for parameter in self.parameters]
+        self.recorder = Recorder(self.path, [parameter.text for parameter in self.parameters], dtypes,
+                                 self.record_format, self.chunk_size, chunk_bytes=self.chunk_bytes)
+        experiment.recorders[self.path] = self.recorder
+
+    def read_variables(self):
+        return operand_names(*self.parameters)
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_record")
+        self.recorder.append([getter() for getter in self.getters])
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+
+class OpParallel(Operation):
+
+    tag = OP_TAG_PARALLEL
+
+    def __init__(self, operation_node):
+        Operation.__init__(self, operation_node)
+        # ogni figlio e' un ramo indipendente, quindi qui non si fa batching
+        self.body = [compile_operation(branch_node) for branch_node in operation_node]
+        self.executor = None
+
+    def validate(self, validator):
+        Operation.validate(self, validator)
+        # i rami non possono scrivere le stesse variabili: dopo il join ogni variabile ha un solo autore
+        written = set()
+        for branch in self.body:
+            for var_name in branch.written_variables():
+                if var_name in written:
+                    validator.error("Variable %s written by more than one branch of parallel" % var_name)
+                written.add(var_name)
+        # ne' leggere quelle scritte da un altro ramo: il valore visto dipenderebbe dai tempi dei thread
+        for index, branch in enumerate(self.body):
+            sibling_written = set()
+            for sibling in self.body[:index] + self.body[index + 1:]:
+                sibling_written |= sibling.written_variables()
+            for var_name in sorted(branch.read_variables() & sibling_written):
+                validator.error("Variable %s read by one branch of parallel and written by another" % var_name)
+
+    def estimate(self, estimator, repeat):
+        # i rami girano insieme: conta il piu' lento
+        started = estimator.estimated_s
+        slowest = 0.0
+        for index, branch in enumerate(self.body):
+            estimator.estimated_s = started
+            estimator.estimate_block([branch], repeat, index)
+            slowest = max(slowest, estimator.estimated_s - started)
+        estimator.estimated_s = started + slowest
+
+    def execute(self):
+        if self.trace:
+            logger.log(TRACE, "Executing op_parallel")
+        if len(self.body) < 2:
+            for operation in self.body:
+                operation.execute()
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(self.body) - 1)
+
+        # il primo ramo gira nel thread chiamante, gli altri nel pool
+        futures = [self.executor.submit(branch.execute) for branch in self.body[1:]]
+        try:
+            self.body[0].execute()
+            wait(futures, return_when=FIRST_EXCEPTION)
+        finally:
+            # join: al primo errore i rami non ancora partiti vengono cancellati, quelli in corso attesi
+            for future in futures:
+                future.cancel()
+            wait(futures)
+        for future in futures:
+            if not future.cancelled() and future.exception() is not None:
+                raise future.exception()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        Operation.close(self)
+
+
+OPERATION_CLASSES = {
+    OP_TAG_WRITE_ATTRIBUTE: OpWriteAttribute,
+    OP_TAG_READ_ATTRIBUTE: OpReadAttribute,
+    OP_TAG_COMMAND_INOUT: OpCommandInout,
+    OP_TAG_CYCLE: OpCycle,
+    OP_TAG_WHILE: OpWhile,
+    OP_TAG_IF: OpIf,
+    OP_TAG_LOG: OpLog,
+    OP_TAG_PARALLEL: OpParallel,
+    OP_TAG_WAIT_UNTIL: OpWaitUntil,
+    OP_TAG_RECORD: OpRecord,
+    OP_TAG_MESH: OpMesh,
+    OP_TAG_SET_VARIABLE: OpSetVariable,
+}
+
+
+# operations addressed to a device group (tango_group_name instead of tango_device_name)
+GROUP_OPERATION_CLASSES = {
+    OP_TAG_WRITE_ATTRIBUTE: OpGroupWriteAttribute,
+    OP_TAG_COMMAND_INOUT: OpGroupCommandInout,
+}
+
+
+def compile_operation(operation_node):
+    if "tango_group_name" in operation_node.attrib and operation_node.tag in GROUP_OPERATION_CLASSES:
+        return GROUP_OPERATION_CLASSES[operation_node.tag](operation_node)
+    if operation_node.tag not in OPERATION_CLASSES:
+        raise Exception("Operation tag not recognized: %s" % operation_node.tag)
+    return OPERATION_CLASSES[operation_node.tag](operation_node)
+
+
+def compile_block(operation_nodes):
+    return batch_operations([compile_operation(operation_node) for operation_node in operation_nodes])
+
+
+class Profiler:
+
+    def __init__(self, max_trace_events=1000000):
+        self.max_trace_events = max_trace_events
+        self.lock = threading.Lock()
+        self.started = time.perf_counter_ns()
+        # node -> [calls, total_ns, max_ns]
+        self.operation_stats = {}
+        # (device, attribute, call) -> [calls, total_ns, max_ns, histogram]
+        self.device_stats = {}
+        self.trace_events = []
+        self.dropped_trace_events = 0
+
+    def add_operation(self, node, start, end):
+        self.add_trace_event(node, "operation", start, end)
+        duration = end - start
+        with self.lock:
+            stats = self.operation_stats.get(node)
+            if stats is None:
+                stats = self.operation_stats[node] = [0, 0, 0]
+            stats[0] += 1
+            stats[1] += duration
+            if duration > stats[2]:
+                stats[2] = duration
+
+    def add_device_call(self, device_name, attr_name, call, start, end):
+        self.add_trace_event("%s %s/%s" % (call, device_name, attr_name), "tango", start, end)
+        duration = end - start
+        # istogramma a bucket log2 dei microsecondi
+        bucket = (duration // 1000).bit_length()
+        with self.lock:
+            key = (device_name, attr_name, call)
+            stats = self.device_stats.get(key)
+            if stats is None:
+                stats = self.device_stats[key] = [0, 0, 0, {}]
+            stats[0] += 1
+            stats[1] += duration
+            if duration > stats[2]:
+                stats[2] = duration
+            stats[3][bucket] = stats[3].get(bucket, 0) + 1
+
+    def add_trace_event(self, name, category, start, end):
+        if len(self.trace_events) >= self.max_trace_events:
+            self.dropped_trace_events += 1
+            return
+        self.trace_events.append({"name": name, "cat": category, "ph": "X", "pid": os.getpid(),
+                                  "tid": threading.get_ident(), "ts": (start - self.started) / 1000.0,
+                                  "dur": (end - start) / 1000.0})
+
+    def mean_latency(self, device_name, attr_name, call):
+        if (device_name, attr_name, call) not in self.device_stats:
+            return None
+        calls, total, _, _ = self.device_stats[(device_name, attr_name, call)]
+        return total / calls / 1e9
+
+    def summary(self):
+        lines = ["%-60s %10s %12s %12s %12s" % ("operation", "calls", "total ms", "mean us", "max us")]
+        for node, (calls, total, maximum) in sorted(self.operation_stats.items(), key=lambda item: -item[1][1]):
+            lines.append("%-60s %10d %12.3f %12.1f %12.1f" % (node, calls, total / 1e6, total / calls / 1e3, maximum / 1e3))
+        lines.append("")
+        lines.append("%-60s %10s %12s %12s %12s  %s" % ("tango call", "calls", "total ms", "mean us", "max us", "histogram (<2^k us: n)"))
+        for (device_name, attr_name, call), (calls, total, maximum, histogram) in sorted(self.device_stats.items(), key=lambda item: -item[1][1]):
+            buckets = " ".join("%d:%d" % (bucket, histogram[bucket]) for bucket in sorted(histogram))
+            lines.append("%-60s %10d %12.3f %12.1f %12.1f  %s" % ("%s %s/%s" % (call, device_name, attr_name), calls,
+                                                                 total / 1e6, total / calls / 1e3, maximum / 1e3, buckets))
+        if self.dropped_trace_events:
+            lines.append("")
+            lines.append("%d trace events dropped" % self.dropped_trace_events)
+        return "\n".join(lines)
+
+    def write_trace(self, trace_file_path):
+        # formato Chrome trace event, apribile in chrome://tracing o Perfetto
+        with open(trace_file_path, "w") as trace_file:
+            json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms"}, trace_file)
+
+
+class ProfiledOperation(Operation):
+
+    def __init__(self, operation, profiler, node):
+        Operation.__init__(self, None)
+        self.operation = operation
+        self.tag = operation.tag
+        self.profiler = profiler
+        self.node = node
+
+    def execute(self):
+        start = time.perf_counter_ns()
+        try:
+            self.operation.execute()
+        finally:
+            self.profiler.add_operation(self.node, start, time.perf_counter_ns())
+
+    def close(self):
+        self.operation.close()
+
+    def written_variables(self):
+        return self.operation.written_variables()
+
+    def read_variables(self):
+        return self.operation.read_variables()
+
+
+def profile_operations(operations, profiler, parent=""):
+    # avvolge ogni nodo dell'albero; senza profiler l'albero resta quello originale
+    profiled = []
+    for index, operation in enumerate(operations):
+        node = "%s/%d:%s" % (parent, index, operation.tag)
+        operation.body[:] = profile_operations(operation.body, profiler, node)
+        profiled.append(ProfiledOperation(operation, profiler, node))
+    return profiled
+
+
+class ProfiledDeviceProxy:
+
+    def __init__(self, proxy, device_name, profiler):
+        self.proxy = proxy
+        self.device_name = device_name
+        self.profiler = profiler
+
+    def read_attribute(self, attr_name, *args):
+        start = time.perf_counter_ns()
+        try:
+            return self.proxy.read_attribute(attr_name, *args)
+        finally:
+            self.profiler.add_device_call(self.device_name, attr_name, "read_attribute", start, time.perf_counter_ns())
+
+    def write_attribute(self, attr_name, value, *args):
+        start = time.perf_counter_ns()
+        try:
+            return self.proxy.write_attribute(attr_name, value, *args)
+        finally:
+            self.profiler.add_device_call(self.device_name, attr_name, "write_attribute", start, time.perf_counter_ns())
+
+    def read_attributes(self, attr_names, *args):
+        start = time.perf_counter_ns()
+        try:
+            return self.proxy.read_attributes(attr_names, *args)
+        finally:
+            self.profiler.add_device_call(self.device_name, ",".join(attr_names), "read_attributes", start, time.perf_counter_ns())
+
+    def write_attributes(self, name_values, *args):
+        start = time.perf_counter_ns()
+        try:
+            return self.proxy.write_attributes(name_values, *args)
+        finally:
+            attr_names = ",".join(attr_name for attr_name, _ in name_values)
+            self.profiler.add_device_call(self.device_name, attr_names, "write_attributes", start, time.perf_counter_ns())
+
+    def command_inout(self, command_name, *args):
+        start = time.perf_counter_ns()
+        try:
+            return self.proxy.command_inout(command_name, *args)
+        finally:
+            self.profiler.add_device_call(self.device_name, command_name, "command_inout", start, time.perf_counter_ns())
+
+    def __getattr__(self, name):
+        return getattr(self.proxy, name)
+
+
+class LatencyModel:
+
+    def __init__(self, latencies=None):
+        # chiavi: call, (device, call) oppure (device, attribute, call); valori in secondi
+        self.latencies = dict(DRY_RUN_LATENCIES)
+        if latencies is not None:
+            self.latencies.update(latencies)
+
+    def learn(self, profiler):
+        # medie misurate da un run profilato; per (device, call) si pesa sul numero di chiamate
+        device_totals = {}
+        for (device_name, attr_name, call), (calls, total, _, _) in profiler.device_stats.items():
+            self.latencies[(device_name, attr_name, call)] = total / calls / 1e9
+            totals = device_totals.setdefault((device_name, call), [0, 0])
+            totals[0] += calls
+            totals[1] += total
+        for key, (calls, total) in device_totals.items():
+            self.latencies[key] = total / calls / 1e9
+
+    def latency(self, device_name, attr_name, call):
+        for key in ((device_name, attr_name, call), (device_name, call), call):
+            if key in self.latencies:
+                return self.latencies[key]
+        return 0.0
+
+    def save(self, path):
+        entries = [list(key) + [latency] if isinstance(key, tuple) else [key, latency]
+                   for key, latency in self.latencies.items()]
+        with open(path, "w") as model_file:
+            json.dump({"version": __version__, "latencies": entries}, model_file, indent=2)
+
+
+def load_latency_model(path):
+    with open(path) as model_file:
+        entries = json.load(model_file)["latencies"]
+    return LatencyModel({(entry[0] if len(entry) == 2 else tuple(entry[:-1])): entry[-1] for entry in entries})
+
+
+def written_attributes(operations):
+    # (device, attributo) scritti dalle operazioni: ogni scrittura invalida la cache di quell'attributo
+    written = set()
+    for operation in operations:
+        if isinstance(operation, OpWriteAttribute):
+            written.add((operation.tango_device_name, operation.attr_name.get()))
+        elif isinstance(operation, OpWriteAttributes):
+            written |= written_attributes(operation.writes)
+        elif isinstance(operation, OpGroupWriteAttribute):
+            written |= {(member_name, operation.attr_name.get()) for member_name in operation.member_names}
+        written |= written_attributes(operation.body)
+    return written
+
+
+def dynamic_variables(operations, in_loop=False):
+    # variabili che cambiano mentre il programma gira: letture di device, contatori di cycle e mesh e
+    # tutto cio' che si scrive nel corpo di un ciclo; le condizioni che le usano non si valutano a secco
+    written = set()
+    for operation in operations:
+        if in_loop or isinstance(operation, (OpReadAttribute, OpReadAttributes, OpWaitUntil, OpCommandInout,
+                                             GroupOperation, OpCycle, OpMesh)):
+            written |= operation.written_variables()
+        written |= dynamic_variables(operation.body, in_loop or isinstance(operation, (OpCycle, OpMesh, OpWhile)))
+    return written
+
+
+class CostEstimator:
+
+    def __init__(self, latency_model=None, while_iterations=DRY_RUN_WHILE_ITERATIONS, while_limit=DRY_RUN_WHILE_LIMIT,
+                 hot_spot_depth=DRY_RUN_HOT_SPOT_DEPTH, hot_spot_fraction=DRY_RUN_HOT_SPOT_FRACTION):
+        self.latency_model = latency_model if latency_model is not None else LatencyModel()
+        self.while_iterations = while_iterations
+        self.while_limit = while_limit
+        self.hot_spot_depth = hot_spot_depth
+        self.hot_spot_fraction = hot_spot_fraction
+        self.dynamic_variables = set()
+        # False mentre si stima il corpo di un while gia' simulato: le sue set_variable non si rieseguono
+        self.replay_variables = True
+        self.node = ""
+        self.depth = 0
+        self.estimated_s = 0.0
+        # (device, attribute, call) -> count
+        self.calls = {}
+        # node -> [device, attribute, call, count, depth, estimated_s]
+        self.sites = {}
+        self.waits = 0
+        self.wait_max_s = 0.0
+        self.assumptions = []
+        # letture in cache: quelle gia' viste e quelle invalidate da scritture nei cicli che le contengono
+        self.cached_attributes = set()
+        self.invalidated_attributes = set()
+
+    def estimate(self, program):
+        self.dynamic_variables = dynamic_variables(program)
+        self.estimate_block(program, 1)
+        return self.report()
+
+    def estimate_block(self, operations, repeat, start=0):
+        parent = self.node
+        for index, operation in enumerate(operations, start):
+            self.node = "%s/%d:%s" % (parent, index, operation.tag)
+            operation.estimate(self, repeat)
+        self.node = parent
+
+    def estimate_loop(self, operations, repeat, iterations, replay_variables=True):
+        self.depth += 1
+        invalidated_attributes = self.invalidated_attributes
+        self.invalidated_attributes = invalidated_attributes | written_attributes(operations)
+        replayed = self.replay_variables
+        self.replay_variables = replayed and replay_variables
+        try:
+            if iterations > 0:
+                self.estimate_block(operations, repeat * iterations)
+        finally:
+            self.depth -= 1
+            self.invalidated_attributes = invalidated_attributes
+            self.replay_variables = replayed
+
+    def is_static(self, var_names):
+        return not (var_names & self.dynamic_variables)
+
+    def assume(self, message):
+        self.assumptions.append(message)
+
+    def add_call(self, device_name, attr_name, call, count):
+        estimated_s = count * self.latency_model.latency(device_name, attr_name, call)
+        self.estimated_s += estimated_s
+        key = (device_name, attr_name, call)
+        self.calls[key] = self.calls.get(key, 0) + count
+        site = self.sites.get(self.node)
+        if site is None:
+            site = self.sites[self.node] = [device_name, attr_name, call, 0, self.depth, 0.0]
+        site[3] += count
+        site[5] += estimated_s
+
+    def add_cached_read(self, device_name, attr_name, count):
+        key = (device_name, attr_name)
+        if key in self.invalidated_attributes:
+            # una scrittura nello stesso ciclo svuota la cache: ogni lettura va al device
+            self.add_call(device_name, attr_name, "read_attribute", count)
+            return
+        misses = 0 if key in self.cached_attributes else 1
+        self.cached_attributes.add(key)
+        if misses:
+            self.add_call(device_name, attr_name, "read_attribute", misses)
+        if count > misses:
+            self.add_call(device_name, attr_name, "cached_read", count - misses)
+
+    def add_fan_out(self, group_name, device_names, attr_name, call, count):
+        # i membri sono chiamati insieme: si contano tutte le chiamate ma il tempo e' quello del piu' lento
+        slowest = 0.0
+        for device_name in device_names:
+            key = (device_name, attr_name, call)
+            self.calls[key] = self.calls.get(key, 0) + count
+            slowest = max(slowest, self.latency_model.latency(device_name, attr_name, call))
+        estimated_s = count * slowest
+        self.estimated_s += estimated_s
+        site = self.sites.get(self.node)
+        if site is None:
+            site = self.sites[self.node] = [group_name, attr_name, call, 0, self.depth, 0.0]
+        site[3] += count * len(device_names)
+        site[5] += estimated_s
+
+    def add_wait(self, count, timeout):
+        self.waits += count
+        if timeout is None:
+            self.wait_max_s = None
+        elif self.wait_max_s is not None:
+            self.wait_max_s += count * timeout
+
+    def hot_spots(self):
+        hot_spots = []
+        for node, (device_name, attr_name, call, count, depth, estimated_s) in sorted(self.sites.items(),
+                                                                                      key=lambda item: -item[1][5]):
+            reasons = []
+            if call in ("read_attribute", "write_attribute") and depth >= self.hot_spot_depth:
+                reasons.append("unbatched %s inside %d nested loops" % (call, depth))
+            if self.estimated_s and estimated_s >= self.hot_spot_fraction * self.estimated_s:
+                reasons.append("%.0f%% of the estimated runtime" % (estimated_s / self.estimated_s * 100))
+            if reasons:
+                hot_spots.append({"node": node, "device": device_name, "attribute": attr_name, "call": call,
+                                  "count": count, "estimated_s": estimated_s, "reasons": reasons})
+        return hot_spots
+
+    def report(self):
+        return {
+            "estimated_s": self.estimated_s,
+            "calls": [{"device": device_name, "attribute": attr_name, "call": call, "count": count,
+                       "estimated_s": count * self.latency_model.latency(device_name, attr_name, call)}
+                      for (device_name, attr_name, call), count in sorted(self.calls.items())],
+            "waits": self.waits,
+            "wait_max_s": self.wait_max_s,
+            "hot_spots": self.hot_spots(),
+            "assumptions": self.assumptions,
+        }
+
+    def summary(self):
+        report = self.report()
+        lines = ["estimated runtime %.3f s (plus up to %s s in %d wait_until)"
+                 % (report["estimated_s"], "unbounded" if report["wait_max_s"] is None else "%.3f" % report["wait_max_s"],
+                    report["waits"]),
+                 "",
+                 "%-60s %12s %12s" % ("tango call", "count", "estimated s")]
+        for call in report["calls"]:
+            lines.append("%-60s %12d %12.3f" % ("%s %s/%s" % (call["call"], call["device"], call["attribute"]),
+                                                call["count"], call["estimated_s"]))
+        for hot_spot in report["hot_spots"]:
+            lines.append("HOT SPOT %s %s %s/%s: %s" % (hot_spot["node"], hot_spot["call"], hot_spot["device"],
+                                                       hot_spot["attribute"], ", ".join(hot_spot["reasons"])))
+        for assumption in report["assumptions"]:
+            lines.append("ASSUMED %s" % assumption)
+        return "\n".join(lines)
+
+
+library_digest = None
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as digest_file:
+        for chunk in iter(lambda: digest_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def experiment_cache_key(xml_file_path):
+    # contenuto dell'xml, formato della cache e sorgente della libreria: le classi delle operazioni
+    # finiscono nel pickle, quindi qualsiasi modifica al codice invalida la cache anche a parita' di __version__
+    global library_digest
+    if library_digest is None:
+        library_digest = file_digest(__file__)
+    key = "%s %s %d %s" % (file_digest(xml_file_path), __version__, EXPERIMENT_CACHE_FORMAT, library_digest)
+    return hashlib.sha256(key.encode()).hexdigest()
 
 
+class Experiment:
 
+    def __init__(self, proxy_pool=None, lazy_devices=False, connect_timeout=None, profiler=None, attribute_cache=None,
+                 cache_dir=None):
+        self.store = VariableStore()
+        self.variables = {}
+        self.devices = {}
+        # group name -> member device names
+        self.groups = {}
+        self.recorders = {}
+        self.program = []
+        # operazioni di primo livello eseguite dall'ultimo run(): il throughput senza bisogno del profiler
+        self.executed_operations = 0
+        self.proxy_pool = proxy_pool if proxy_pool is not None else PROXY_POOL
+        self.lazy_devices = lazy_devices
+        self.connect_timeout = connect_timeout
+        self.profiler = profiler
+        self.attribute_cache = attribute_cache if attribute_cache is not None else AttributeCache()
+        # directory della cache degli esperimenti gia' compilati e validati; None = niente cache
+        self.cache_dir = cache_dir
 
+    def parse_xml(self, xml_file_path):
+        self.load_xml(xml_file_path)
+        try:
+            self.run()
+        finally:
+            self.close()
+
+    def load_xml(self, xml_file_path):
+        cached = None
+        if self.cache_dir is not None:
+            cache_path = os.path.join(self.cache_dir, experiment_cache_key(xml_file_path) + EXPERIMENT_CACHE_SUFFIX)
+            cached = self.load_cache(cache_path)
+        if cached is not None:
+            device_declarations, group_declarations, program = cached
+        else:
+            device_declarations, group_declarations, program = self.compile_xml(xml_file_path)
+            if self.cache_dir is not None:
+                self.save_cache(cache_path, device_declarations, group_declarations, program)
+        self.groups.update(group_declarations)
+        self.connect_devices(device_declarations)
+        self.program = self.link_operations(program)
+
+    def compile_xml(self, xml_file_path):
+        # il file viene letto in streaming: ogni variabile/device/operazione di primo livello
+        # viene elaborata appena chiusa e poi tolta dall'albero, cosi' la memoria non cresce col file
+        device_declarations = []
+        group_declarations = []
+        program = []
+        parents = []
+        for event, element in ElementTree.iterparse(xml_file_path, events=("start", "end")):
+            if event == "start":
+                parents.append(element)
+                continue
+            parents.pop()
+            if len(parents) != 2:
+                continue
+            section = parents[1]
+            if section.tag == "variables" and element.tag == "variable":
+                self.declare_variable(element)
+            elif section.tag == "devices" and element.tag == "device":
+                device_declarations.append(self.declare_device(element))
+            elif section.tag == "devices" and element.tag == "group":
+                group_declarations.append(self.declare_group(element))
+            elif section.tag == "operations":
+                program.append(compile_operation(element))
+            else:
+                continue
+            section.remove(element)
+
+        # tutto il programma viene controllato prima di toccare qualsiasi device
+        self.validate(program, [device_name for device_name, _, _ in device_declarations], group_declarations)
+        return device_declarations, group_declarations, batch_operations(program)
+
+    def save_cache(self, cache_path, device_declarations, group_declarations, program):
+        # prima del link le operazioni sono solo dati: si salvano insieme a variabili e policy della cache attributi
+        device_names = {device_name for device_name, _, _ in device_declarations}
+        cache_policies = {key: ttl for key, ttl in self.attribute_cache.policies.items() if key[0] in device_names}
+        # la tabella delle variabili va per colonne, in ordine di slot: molto piu' compatta degli oggetti
+        names = sorted(self.store.slots, key=self.store.slots.get)
+        types = [self.variables[idata_name].idata_type for idata_name in names]
+        state = (names, types, self.store.values, device_declarations, group_declarations, program, cache_policies)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temporary_path = "%s.%d.tmp" % (cache_path, os.getpid())
+            with open(temporary_path, "wb") as cache_file:
+                pickle.dump(state, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, cache_path)
+        except Exception as error:
+            logger.warning("Cannot write experiment cache %s: %s", cache_path, error)
+
+    def load_cache(self, cache_path):
+        # la cache e' locale e scritta da noi; se manca o e' rovinata si ricompila dall'xml
+        if not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path, "rb") as cache_file:
+                names, types, values, device_declarations, group_declarations, program, cache_policies = pickle.load(cache_file)
+        except Exception as error:
+            logger.warning("Ignoring experiment cache %s: %s", cache_path, error)
+            return None
+        self.store, self.variables = restore_variables(names, types, values)
+        for (device_name, attr_name), ttl in cache_policies.items():
+            self.attribute_cache.configure(device_name, attr_name, ttl)
+        return device_declarations, group_declarations, program
+
+    def dry_run(self, xml_file_path, estimator=None):
+        # i device sono simulati e nessuna operazione su device viene eseguita: si contano soltanto
+        self.proxy_pool = ProxyPool(simulated_proxy_factory())
+        self.lazy_devices = False
+        self.profiler = None
+        estimator = estimator if estimator is not None else CostEstimator()
+        self.load_xml(xml_file_path)
+        try:
+            estimator.estimate(self.program)
+        finally:
+            self.close()
+        return estimator
+
+    def declare_variable(self, variable_node):
+        current_idata_name = variable_node.attrib["name"]
+        current_idata_type = variable_node.attrib["type"]
+        current_idata_value = []
+
+        element_nodes = variable_node.findall("element")
+
+        for element_node in element_nodes:
+            current_idata_value.append(element_node.attrib["value"])
+
+        if "scalar" in current_idata_type and not len(current_idata_value) == 1:
+            raise Exception("Incorrect value %s for idata_type %s" % (current_idata_value, current_idata_type))
+        if "state" in current_idata_type and not len(current_idata_value) == 1:
+            raise Exception("Incorrect value %s for idata_type %s" % (current_idata_value, current_idata_type))
+        elif "spectrum" in current_idata_type and len(current_idata_value) == 1:
+            raise Exception("Incorrect value %s for idata_type %s" % (current_idata_value, current_idata_type))
+        else:
+            current_idata = InternalData(current_idata_name, current_idata_value, current_idata_type, self.store)
+            self.variables[current_idata_name] = current_idata
+
+    def declare_device(self, device_node):
+        # il default dell'esperimento si applica alla connessione, cosi' la dichiarazione si puo' mettere in cache
+        connect_timeout = None
+        if "connect_timeout" in device_node.attrib:
+            connect_timeout = float(device_node.attrib["connect_timeout"])
+        # <cache attr="..." ttl="s"/> oppure senza ttl: valido fino al prossimo change event
+        for cache_node in device_node.findall("cache"):
+            ttl = float(cache_node.attrib["ttl"]) if "ttl" in cache_node.attrib else None
+            self.attribute_cache.configure(device_node.attrib["name"], cache_node.attrib["attr"], ttl)
+        return device_node.attrib["name"], device_node.attrib["tango_path"], connect_timeout
+
+    def declare_group(self, group_node):
+        # <group name="..." members="dev1,dev2"/> oppure con figli <member device="..."/>
+        member_names = [member_name.strip() for member_name in group_node.attrib.get("members", "").split(",")
+                        if member_name.strip()]
+        member_names += [member_node.attrib["device"] for member_node in group_node.findall("member")]
+        return group_node.attrib["name"], member_names
+
+    def validate(self, program, device_names, group_declarations=()):
+        group_names = {group_name for group_name, _ in group_declarations} | set(self.groups)
+        validator = Validator(self.variables, set(device_names), group_names)
+        for group_name, member_names in group_declarations:
+            if group_name in device_names:
+                validator.error("Group %s has the same name as a device" % group_name)
+            if not member_names:
+                validator.error("Group %s has no members" % group_name)
+            for member_name in member_names:
+                validator.device(member_name)
+        for operation in program:
+            operation.validate(validator)
+        validator.check()
+
+    def connect_devices(self, device_declarations):
+        device_names = [device_name for device_name, _, _ in device_declarations]
+        tango_paths = [tango_path for _, tango_path, _ in device_declarations]
+        connect_timeouts = [connect_timeout if connect_timeout is not None else self.connect_timeout
+                            for _, _, connect_timeout in device_declarations]
+
+        if self.lazy_devices:
+            proxies = [self.proxy_pool.lazy(tango_path, connect_timeout)
+                       for tango_path, connect_timeout in zip(tango_paths, connect_timeouts)]
+        else:
+            proxies = self.proxy_pool.get_all(tango_paths, connect_timeouts)
+        for device_name, proxy in zip(device_names, proxies):
+            if self.profiler is not None:
+                proxy = ProfiledDeviceProxy(proxy, device_name, self.profiler)
+            self.devices[device_name] = proxy
+
+    def link_operations(self, program):
+        # il programma e' gia' validato: qui si risolvono solo slot e device
+        configure_default_logging()
+        Operation.trace = logger.isEnabledFor(TRACE)
+        for operation in program:
+            operation.link(self)
+        if self.profiler is not None:
+            program = profile_operations(program, self.profiler)
+        return program
+
+    def run(self):
+        self.executed_operations = 0
+        for operation in self.program:
+            operation.execute()
+            self.executed_operations += 1
+
+    def close(self):
+        for operation in self.program:
+            operation.close()
+        self.attribute_cache.close()
+
+    def parse_operation(self, operation_node):
+        operation = compile_operation(operation_node)
+        self.validate([operation], self.devices)
+        operation = self.link_operations([operation])[0]
+        try:
+            operation.execute()
+        finally:
+            operation.close()
+
+    def get_device(self, tango_device_name):
+        if tango_device_name not in self.devices:
+            raise Exception("device_name %s not in devices dicionary" % tango_device_name)
+        return self.devices[tango_device_name]
+
+
+def experiment_tango_paths(xml_file_path):
+    # legge solo la sezione <devices>, senza compilare variabili e operazioni
+    tango_paths = set()
+    section = None
+    for event, element in ElementTree.iterparse(xml_file_path, events=("start", "end")):
+        if event == "start":
+            if element.tag in ("variables", "devices", "operations"):
+                section = element.tag
+            continue
+        if section == "devices" and element.tag == "device":
+            tango_paths.add(element.attrib["tango_path"])
+        elif element.tag == "devices":
+            break
+    return frozenset(tango_paths)
+
+
+class ScheduledExperiment:
+
+    def __init__(self, xml_file_path, tango_paths):
+        self.xml_file_path = xml_file_path
+        self.tango_paths = tango_paths
+        self.future = Future()
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.loaded = None
+        self.finished = None
+        self.operations = None
+
+    def report(self):
+        report = {
+            "xml_file_path": self.xml_file_path,
+            "tango_paths": sorted(self.tango_paths),
+            "queue_latency_s": self.started - self.submitted if self.started is not None else None,
+            "load_s": self.loaded - self.started if self.loaded is not None else None,
+            "run_s": self.finished - self.loaded if self.finished is not None and self.loaded is not None else None,
+            "operations": self.operations,
+            "ops_per_s": None,
+            "error": None,
+        }
+        if self.operations is not None and report["run_s"]:
+            report["ops_per_s"] = self.operations / report["run_s"]
+        if self.future.done() and self.future.exception() is not None:
+            report["error"] = str(self.future.exception())
+        return report
+
+
+class ExperimentScheduler:
+
+    def __init__(self, max_workers=None, proxy_pool=None, profile=False, **experiment_options):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="experiment")
+        self.proxy_pool = proxy_pool if proxy_pool is not None else PROXY_POOL
+        # le operazioni di primo livello si contano sempre; con profile ogni esperimento ha il suo Profiler
+        # e il report conta anche quelle annidate
+        self.profile = profile
+        self.experiment_options = experiment_options
+        self.lock = threading.Lock()
+        self.pending = []
+        self.busy_paths = set()
+        self.jobs = []
+
+    def submit(self, xml_file_path):
+        return self.enqueue(xml_file_path).future
+
+    def enqueue(self, xml_file_path):
+        job = ScheduledExperiment(xml_file_path, experiment_tango_paths(xml_file_path))
+        with self.lock:
+            self.jobs.append(job)
+            self.pending.append(job)
+            self.dispatch()
+        return job
+
+    def dispatch(self):
+        # un esperimento parte solo se nessuno dei suoi tango_path e' in uso o prenotato da uno
+        # sottomesso prima: chi condivide device viene eseguito in ordine di arrivo
+        blocked = set(self.busy_paths)
+        for job in list(self.pending):
+            if job.tango_paths & blocked:
+                blocked |= job.tango_paths
+                continue
+            self.pending.remove(job)
+            self.busy_paths |= job.tango_paths
+            blocked |= job.tango_paths
+            self.executor.submit(self.run_job, job)
+
+    def run_job(self, job):
+        job.started = time.perf_counter()
+        try:
+            profiler = Profiler(max_trace_events=0) if self.profile else None
+            experiment = Experiment(self.proxy_pool, profiler=profiler, **self.experiment_options)
+            try:
+                experiment.load_xml(job.xml_file_path)
+                job.loaded = time.perf_counter()
+                experiment.run()
+            finally:
+                experiment.close()
+            job.finished = time.perf_counter()
+            if profiler is not None:
+                job.operations = sum(stats[0] for stats in profiler.operation_stats.values())
+            else:
+                job.operations = experiment.executed_operations
+            job.future.set_result(job.report())
+        except BaseException as error:
+            job.finished = time.perf_counter()
+            logger.error("Experiment %s failed: %s", job.xml_file_path, error)
+            job.future.set_exception(error)
+        finally:
+            with self.lock:
+                self.busy_paths -= job.tango_paths
+                self.dispatch()
+
+    def run(self, xml_file_paths):
+        jobs = [self.enqueue(xml_file_path) for xml_file_path in xml_file_paths]
+        wait([job.future for job in jobs])
+        return [job.report() for job in jobs]
+
+    def reports(self):
+        with self.lock:
+            return [job.report() for job in self.jobs]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)